@@ -10,14 +10,17 @@ pages = {
             ['server', 'status'],
             ['visaResource', 'dateTime'],
             ['acqCount', 'scopeAcqCount', 'lostTrigs'],
+            ['lostTrigRate', 'deadTime'],
             ['instrCtrl', 'instrCmdS', 'instrCmdR'],
         ]
     },
     'Horizontal': {
         'layout': [
             ['timePerDiv', 'recLengthS', 'recLengthR'],
-            ['samplingRate'],
-            ['tAxis'],
+            ['samplingRate', 'xOrigin', 'xIncrement'],
+            ['previewPoints', 'fullEvery'],
+            ['roiStart', 'roiLength'],
+            ['tAxis', 'tAxisPreview'],
         ]
     },
     'Trigger': {
@@ -26,6 +29,7 @@ pages = {
             ['trigType', 'trigSource', 'trigSlope'],
             ['trigLevel', 'trigDelay'],
             ['trigCoupling'],
+            ['trigWait', 'trigTimeout', 'nSegments'],
         ]
     },
     'Channel1': {
@@ -33,7 +37,9 @@ pages = {
             ['c01OnOff', 'c01Coupling', 'c01Termination'],
             ['c01VoltsPerDiv', 'c01VoltOffset'],
             ['c01Mean', 'c01Peak2Peak'],
-            ['c01Waveform'],
+            ['c01RMS', 'c01RiseTime', 'c01Area', 'c01GateIntegral'],
+            ['c01RawScale', 'c01RawOffset'],
+            ['c01Waveform', 'c01WaveformPreview'],
         ]
     },
     'Channel2': {
@@ -41,7 +47,9 @@ pages = {
             ['c02OnOff', 'c02Coupling', 'c02Termination'],
             ['c02VoltsPerDiv', 'c02VoltOffset'],
             ['c02Mean', 'c02Peak2Peak'],
-            ['c02Waveform'],
+            ['c02RMS', 'c02RiseTime', 'c02Area', 'c02GateIntegral'],
+            ['c02RawScale', 'c02RawOffset'],
+            ['c02Waveform', 'c02WaveformPreview'],
         ]
     },
     'Channel3': {
@@ -49,7 +57,9 @@ pages = {
             ['c03OnOff', 'c03Coupling', 'c03Termination'],
             ['c03VoltsPerDiv', 'c03VoltOffset'],
             ['c03Mean', 'c03Peak2Peak'],
-            ['c03Waveform'],
+            ['c03RMS', 'c03RiseTime', 'c03Area', 'c03GateIntegral'],
+            ['c03RawScale', 'c03RawOffset'],
+            ['c03Waveform', 'c03WaveformPreview'],
         ]
     },
     'Channel4': {
@@ -57,13 +67,33 @@ pages = {
             ['c04OnOff', 'c04Coupling', 'c04Termination'],
             ['c04VoltsPerDiv', 'c04VoltOffset'],
             ['c04Mean', 'c04Peak2Peak'],
-            ['c04Waveform'],
+            ['c04RMS', 'c04RiseTime', 'c04Area', 'c04GateIntegral'],
+            ['c04RawScale', 'c04RawOffset'],
+            ['c04Waveform', 'c04WaveformPreview'],
         ]
     },
     'Setup': {
         'layout': [
-            ['setup'],
-            ['timing'],
+            ['setup', 'readoutMode', 'wfFormat', 'dataFormat'],
+            ['queuePolicy', 'queueDepth', 'queueDrops'],
+            ['settingsCheck', 'slowPollEvery'],
+            ['pollMode', 'trigRate'],
+            ['pollIntervalMin', 'pollIntervalMax', 'pollInterval'],
+            ['settingsIntervalMin', 'settingsIntervalMax', 'settingsInterval'],
+            ['recordCtrl', 'recordPath', 'recordFile'],
+            ['recordSize', 'recordRollover'],
+            ['recordBytes', 'recordRate', 'recordDrops'],
+            ['statistics', 'measMode', 'measFullEvery'],
+            ['gateStart', 'gateStop'],
+            ['avgMode', 'avgCount', 'avgShots'],
+            ['persist', 'persistTimeBins', 'persistAmpBins'],
+            ['accumInterval', 'accumReset'],
+            ['historyDepth', 'historyFreeze', 'historyCount'],
+            ['historySelect', 'historyFirst', 'historyLast', 'historyFetch'],
+            ['timingWindow', 'timingStages'],
+            ['timingCount', 'timingMean'],
+            ['timingP50', 'timingP95'],
+            ['timingP99', 'timingMax'],
         ]
     },
 }
@@ -7,17 +7,31 @@ import time
 from time import perf_counter as timer
 import argparse
 import threading
+import queue
+import socket
+import os
+import json
+import hashlib
+import collections
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 import pyvisa as visa
+from pyvisa import constants
 from pyvisa.errors import VisaIOError
 
 from epicsdev import epicsdev as edev
+from epicsdev_rohde import recorder, wavestats
 
 #``````````````````PVs defined here```````````````````````````````````````````
 def myPVDefs():
     """PV definitions"""
     SET,U,LL,LH,SCPI = 'setter','units','limitLow','limitHigh','scpi'
+    # polling priority of the settings, default: every periodic update
+    POLL,CRITICAL,SLOW = 'poll','critical','slow'
     alarm = {'valueAlarm':{'lowAlarmLimit':-9., 'highAlarmLimit':9.}}
     pvDefs = [
 # instruments's PVs
@@ -29,6 +43,8 @@ def myPVDefs():
 ['acqCount',    'Number of acquisition recorded', edev.SPV(0), {}],
 ['scopeAcqCount',  'Acquisition count of the scope', edev.SPV(0), {}],
 ['lostTrigs',   'Number of triggers lost',  edev.SPV(0), {}],
+['lostTrigRate', 'Rate of lost triggers', edev.SPV(0.), {U:'Hz'}],
+['deadTime',    'Fraction of time, when the scope was not armed', edev.SPV(0.), {}],
 ['instrCtrl',   'Scope control commands',
     edev.SPV('*IDN?,*RST,*CLS,*ESR?,*OPC?,*STB?'.split(','),'WD'), {}],
 ['instrCmdS',   'Execute a scope command. Features: RWE',  edev.SPV('*IDN?','W'), {
@@ -39,35 +55,135 @@ def myPVDefs():
     edev.SPV(['AUTO','1k','10k','100k','1M','10M','50M','100M','200M'],'WD'), {
     SET:set_recLengthS}],
 ['recLengthR',   'Number of points per waveform read', edev.SPV(0.), {
-    SCPI:'ACQuire:POINts'}],
+    SCPI:'ACQuire:POINts', POLL:CRITICAL}],
 ['samplingRate', 'Sampling Rate',  edev.SPV(0.), {U:'Hz',
     SCPI:'ACQuire:SRATe'}],
 ['timePerDiv', f'Horizontal scale (1/{NDIVSX} of full scale)', edev.SPV(2.e-6,'W'), {U:'S/du',
-    SCPI: 'TIMebase:SCALe', SET:set_scpi}],
-['tAxis',       'Horizontal axis array', edev.SPV([0.]), {U:'S'}],
+    SCPI: 'TIMebase:SCALe', SET:set_scpi, POLL:CRITICAL}],
+['tAxis',       'Horizontal axis array, published only when it has clients, empty when outdated',
+    edev.SPV([0.]), {U:'S'}],
+['xOrigin',     'Time of the first waveform point', edev.SPV(0.,'','f64'), {U:'S'}],
+['xIncrement',  'Time between waveform points', edev.SPV(0.,'','f64'), {U:'S'}],
+['tAxisPreview', 'Horizontal axis of the waveform previews', edev.SPV([0.]), {U:'S'}],
+['previewPoints', 'Number of points in the waveform previews, 0: previews disabled',
+    edev.SPV(2000,'W','u32'), {LL:0, LH:100000}],
+['roiStart',  'Start time of the region of interest, relative to trigger', edev.SPV(0.,'W','f64'), {U:'S',
+    SET:set_roi}],
+['roiLength', 'Length of the region of interest, only this part of the record is transferred, 0: full record',
+    edev.SPV(0.,'W','f64'), {U:'S', LL:0., SET:set_roi}],
+['nSegments', 'Number of triggers, captured into the history memory and read out in one transfer, 1: segmentation off',
+    edev.SPV(1,'W','u32'), {LL:1, LH:100000, SET:set_nSegments}],
+['fullEvery', 'Publish full-resolution waveforms every Nth acquisition, 0: never',
+    edev.SPV(1,'W','u32'), {LL:0, LH:1000000}],
+['measFullEvery', 'In Measurements mode: transfer and publish the waveforms every Nth acquisition, 0: never',
+    edev.SPV(0,'W','u32'), {LL:0, LH:1000000}],
+['measMode', 'Source of c<n>Mean and c<n>Peak2Peak: Waveforms - calculated from transferred waveforms, Measurements - measured by the scope',
+    edev.SPV(['Waveforms','Measurements'],'WD'), {SET:set_measMode}],
 
 #``````````````````Trigger PVs
 ['trigger',     'Click to force trigger event to occur',
     edev.SPV(['Trigger','Force!'],'WD'), {SET:set_trigger}],
 ['trigType',   'Trigger type', edev.SPV(['EDGE','PULS','WIDTH','SLOP','RUNT'],'WD'),{
-    SCPI:'TRIGger:TYPE', SET:set_scpi}],
+    SCPI:'TRIGger:TYPE', SET:set_scpi, POLL:SLOW}],
 ['trigCoupling',   'Trigger coupling', edev.SPV(['DC','AC','LFR','HFR'],'WD'),{
-    SCPI:'TRIGger:EDGE:COUPling', SET:set_scpi}],
+    SCPI:'TRIGger:EDGE:COUPling', SET:set_scpi, POLL:SLOW}],
 ['trigState',   'Current trigger status', edev.SPV('?'),{
     SCPI:'TRIGger:STATe'}],
 ['trigMode',   'Trigger mode', edev.SPV(['NORM','AUTO','SING'],'WD'),{
-    SCPI:'TRIGger:MODE', SET:set_scpi}],
+    SCPI:'TRIGger:MODE', SET:set_scpi, POLL:SLOW}],
 ['trigDelay',   'Trigger delay/position', edev.SPV(0.,'W'), {U:'S',
     SCPI:'TIMebase:HORizontal:POSition', SET:set_scpi}],
 ['trigSource', 'Trigger source',
     edev.SPV('CHAN1,CHAN2,CHAN3,CHAN4,EXT'.split(','),'WD'),{
-    SCPI:'TRIGger:SOURce', SET:set_scpi}],
+    SCPI:'TRIGger:SOURce', SET:set_scpi, POLL:SLOW}],
 ['trigSlope',  'Trigger slope', edev.SPV(['POS','NEG','EITH'],'WD'),{
-    SCPI:'TRIGger:EDGE:SLOPe', SET:set_scpi}],
+    SCPI:'TRIGger:EDGE:SLOPe', SET:set_scpi, POLL:SLOW}],
 ['trigLevel', 'Trigger level', edev.SPV(0.,'W'), {U:'V',
     SCPI:'TRIGger:LEVel', SET:set_scpi}],
 #``````````````````Auxiliary PVs
-['timing',  'Performance timing', edev.SPV([0.]), {U:'S'}],
+['timingStages', 'Labels of the timing PVs', edev.SPV(list(Stages)), {}],
+['timingWindow', 'Number of latest samples in timing statistics', edev.SPV(1000,'W','u32'), {
+    LL:10, LH:100000, SET:set_timingWindow}],
+['timingCount', 'Number of samples per stage in the window', edev.SPV([0]), {}],
+['timingMean',  'Mean time per stage', edev.SPV([0.]), {U:'S'}],
+['timingP50',   'Median time per stage', edev.SPV([0.]), {U:'S'}],
+['timingP95',   '95th percentile of time per stage', edev.SPV([0.]), {U:'S'}],
+['timingP99',   '99th percentile of time per stage', edev.SPV([0.]), {U:'S'}],
+['timingMax',   'Max time per stage', edev.SPV([0.]), {U:'S'}],
+['slowPollEvery', 'Static settings (coupling, trigger type...) are read every Nth periodic update',
+    edev.SPV(6,'W','u32'), {LL:1, LH:1000}],
+['settingsCheck', 'Poll - read static settings every slowPollEvery updates, ESR - also when *ESR? reports an event',
+    edev.SPV(['Poll','ESR'],'WD'), {}],
+['pollMode', 'Main-loop cadence: Fixed - sleep PV, Adaptive - trigger-poll and settings intervals follow the trigger rate',
+    edev.SPV(['Fixed','Adaptive'],'WD'), {}],
+['pollIntervalMin', 'Shortest trigger-poll interval in Adaptive mode', edev.SPV(0.001,'W'), {U:'S',
+    LL:0., LH:10.}],
+['pollIntervalMax', 'Longest trigger-poll interval in Adaptive mode, used when no triggers are detected',
+    edev.SPV(1.,'W'), {U:'S', LL:0., LH:10.}],
+['settingsIntervalMin', 'Shortest settings-refresh interval in Adaptive mode', edev.SPV(1.,'W'), {U:'S',
+    LL:0., LH:3600.}],
+['settingsIntervalMax', 'Longest settings-refresh interval in Adaptive mode', edev.SPV(10.,'W'), {U:'S',
+    LL:0., LH:3600.}],
+['trigRate', 'Estimated rate of detected triggers', edev.SPV(0.), {U:'Hz'}],
+['pollInterval', 'Current trigger-poll interval', edev.SPV(0.), {U:'S'}],
+['settingsInterval', 'Current settings-refresh interval', edev.SPV(0.), {U:'S'}],
+['recordCtrl', 'Recording of raw waveforms to the ring files',
+    edev.SPV(['Stop','Start'],'WD'), {SET:set_recordCtrl}],
+['recordPath', 'Path and name prefix of the recording files', edev.SPV('/tmp/rohde','W'), {}],
+['recordSize', 'Size of the recording ring file', edev.SPV(1000.,'W'), {U:'MB',
+    LL:1., LH:1.e6}],
+['recordRollover', 'Start new recording file after this time, 0: never', edev.SPV(0.,'W'), {U:'S',
+    LL:0., LH:1.e7}],
+['recordFile',  'Current recording file', edev.SPV(''), {}],
+['recordBytes', 'Bytes written to the current recording file', edev.SPV(0,'','u64'), {U:'B'}],
+['recordRate',  'Recording rate', edev.SPV(0.), {U:'MB/s'}],
+['recordDrops', 'Number of acquisitions not recorded due to full recording queue', edev.SPV(0), {}],
+['statistics', 'Waveform statistics: Basic - Mean, Peak2Peak; Full - also RMS, RiseTime, Area, GateIntegral',
+    edev.SPV(['Basic','Full'],'WD'), {}],
+['gateStart', 'Start of the integration gate of c<n>GateIntegral', edev.SPV(0.,'W','f64'), {U:'S'}],
+['gateStop',  'End of the integration gate of c<n>GateIntegral', edev.SPV(0.,'W','f64'), {U:'S'}],
+['avgMode', 'Server-side averaging of the waveforms: Cumulative - mean of all shots since reset, Exponential - weight 1/avgCount',
+    edev.SPV(['Off','Cumulative','Exponential'],'WD'), {SET:set_accumulator}],
+['avgCount', 'Number of shots, averaged by the exponential average', edev.SPV(16,'W','u32'), {
+    LL:1, LH:1000000}],
+['avgShots', 'Number of shots in the averages', edev.SPV(0), {}],
+['persist', 'Accumulation of the persistence histograms c<n>Persistence',
+    edev.SPV(['Off','On'],'WD'), {SET:set_accumulator}],
+['persistTimeBins', 'Number of time bins of the persistence histograms', edev.SPV(500,'W','u32'), {
+    LL:1, LH:10000, SET:set_accumulator}],
+['persistAmpBins', 'Number of amplitude bins of the persistence histograms, covering the raw range', edev.SPV(256,'W','u32'), {
+    LL:2, LH:4096, SET:set_accumulator}],
+['accumInterval', 'Interval of publishing of the averages and persistence histograms', edev.SPV(1.,'W'), {U:'S',
+    LL:0., LH:3600.}],
+['accumReset', 'Click to reset the averages and persistence histograms',
+    edev.SPV(['Reset','Reset!'],'WD'), {SET:set_accumulator}],
+['historyDepth', 'Number of latest acquisitions kept in memory, 0: history disabled',
+    edev.SPV(0,'W','u32'), {LL:0, LH:100000, SET:set_historyDepth}],
+['historyFreeze', 'Freeze the history, new acquisitions are not stored',
+    edev.SPV(['Run','Freeze'],'WD'), {}],
+['historyCount', 'Number of acquisitions in the history', edev.SPV(0), {}],
+['historySelect', 'Selection of the fetched acquisitions: Shots - by acqCount, Time - by trigger time',
+    edev.SPV(['Shots','Time'],'WD'), {}],
+['historyFirst', 'First acqCount or trigger time (S since Epoch) to fetch', edev.SPV(0.,'W','f64'), {}],
+['historyLast',  'Last acqCount or trigger time (S since Epoch) to fetch', edev.SPV(0.,'W','f64'), {}],
+['historyFetch', 'Click to publish the selected acquisitions in c<n>History',
+    edev.SPV(['Fetch','Fetch!'],'WD'), {SET:set_historyFetch}],
+['historyCounts', 'acqCounts of the fetched acquisitions', edev.SPV([0],'','i64'), {}],
+['historyTimes', 'Trigger times of the fetched acquisitions', edev.SPV([0.],'','f64'), {U:'S'}],
+['trigWait', 'Trigger detection: Poll - TRIGger:STATe? polling, OPC - operation complete in *ESR?, SRQ - service request event',
+    edev.SPV(['Poll','OPC','SRQ'],'WD'), {SET:set_trigWait}],
+['trigTimeout', 'Max time to wait for trigger in OPC and SRQ modes', edev.SPV(1.,'W'), {U:'S',
+    LL:0.01, LH:60.}],
+['queuePolicy', 'Action when the processing queue is full: Drop - drop the acquisition, Block - delay the readout',
+    edev.SPV(['Drop','Block'],'WD'), {}],
+['queueDepth',  'Number of acquisitions waiting for processing', edev.SPV(0), {}],
+['queueDrops',  'Number of triggers dropped due to full processing queue, they are counted in lostTrigs too', edev.SPV(0), {}],
+['wfFormat', 'Waveform publishing: Float - c<n>Waveform, Raw - c<n>WaveformRaw with scale, Both',
+    edev.SPV(['Float','Raw','Both'],'WD'), {}],
+['dataFormat', 'Transfer format of the waveforms: INT,8 halves the transfer time of INT,16, REAL,32 - samples in volts',
+    edev.SPV(list(WireFormats),'WD'), {SET:set_dataFormat}],
+['readoutMode', 'Waveform readout: Combined - all channels in one transfer, PerChannel - one transfer per channel',
+    edev.SPV(['Combined','PerChannel'],'WD'), {}],
     ]
 
     #``````````````Templates for channel-related PVs.
@@ -75,17 +191,31 @@ def myPVDefs():
     # Important: SPV cannot be used in this list!
     ChannelTemplates = [
 ['c<n>OnOff', 'Enable/disable channel', (['ON','OFF'],'WD'),{
-    SCPI:'CHANnel<n>:STATe', SET:set_scpi}],
+    SCPI:'CHANnel<n>:STATe', SET:set_scpi, POLL:CRITICAL}],
 ['c<n>Coupling', 'Channel coupling', (['DC','AC','GND'],'WD'),{
-    SCPI:'CHANnel<n>:COUPling', SET:set_scpi}],
+    SCPI:'CHANnel<n>:COUPling', SET:set_scpi, POLL:SLOW}],
 ['c<n>VoltsPerDiv',  'Vertical scale',  (1E-3,'W'), {U:'V/du',
     SCPI:'CHANnel<n>:SCALe', SET:set_scpi, LL:500E-6, LH:10.}],
 ['c<n>VoltOffset',  'Vertical offset',  (0.,'W'), {U:'V',
     SCPI:'CHANnel<n>:OFFSet', SET:set_scpi}],
 ['c<n>Termination', 'Input termination', ('1M','R'), {U:'Ohm'}],# typically 50 or 1M
-['c<n>Waveform', 'Waveform array',           ([0.],), {U:'du'}],
+['c<n>Waveform', 'Waveform array',           ([0.],), {U:'V'}],
+['c<n>WaveformPreview', 'Min/max envelope of the waveform', ([0.],), {U:'V'}],
+['c<n>WaveformRaw', 'Raw waveform, V = raw*RawScale + RawOffset', ([0],'','s16'), {U:'count'}],
+['c<n>RawScale', 'Scale of the raw waveform', (0.,), {U:'V/count'}],
+['c<n>RawOffset','Offset of the raw waveform', (0.,), {U:'V'}],
+['c<n>Average', 'Average of the waveforms', ([0.],), {U:'V'}],
+['c<n>Persistence', 'Persistence histogram, persistTimeBins rows of persistAmpBins counts; amplitude of bin j: (j+0.5)*2**b/persistAmpBins - 2**(b-1) raw counts, b: 8 bits for INT,8, otherwise 16',
+    ([0],'','u32'), {}],
+['c<n>History', 'Raw waveforms of the fetched acquisitions, concatenated', ([0],'','s16'), {U:'count'}],
+['c<n>HistoryGain', 'Scale of the fetched raw waveforms, per acquisition', ([0.],), {U:'V/count'}],
+['c<n>HistoryOffset', 'Offset of the fetched raw waveforms, per acquisition', ([0.],), {U:'V'}],
 ['c<n>Mean',     'Mean of the waveform',     (0.,'A'), {U:'V'}],
 ['c<n>Peak2Peak','Peak-to-peak amplitude',   (0.,'A'), {U:'V',**alarm}],
+['c<n>RMS',      'RMS of the waveform',      (0.,), {U:'V'}],
+['c<n>RiseTime', '10-90% rise time of the first complete rising edge, NaN if there is none', (0.,), {U:'S'}],
+['c<n>Area',     'Integral of the waveform', (0.,), {U:'V*S'}],
+['c<n>GateIntegral', 'Integral of the waveform from gateStart to gateStop', (0.,), {U:'V*S'}],
     ]
     # extend PvDefs with channel-related PVs
     for ch in range(pargs.channels):
@@ -96,18 +226,72 @@ def myPVDefs():
             pvDefs.append(newpvdef)
     return pvDefs
 #,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,
+#``````````````````Instrument lock
+class PriorityLock():
+    """Non-reentrant lock of the instrument I/O. The waveform readout takes
+    it through urgent(): while it is waiting, the lock is not granted to
+    other users (settings polls, setters), so they cannot delay the readout."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.owned = False
+        self.urgentWaiters = 0
+
+    def acquire(self, blocking=True, urgent=False):
+        """Acquire the lock, return False if not blocking and it is busy"""
+        with self.cond:
+            self.urgentWaiters += urgent
+            try:
+                while self.owned or (self.urgentWaiters and not urgent):
+                    if not blocking:
+                        return False
+                    self.cond.wait()
+                self.owned = True
+                return True
+            finally:
+                self.urgentWaiters -= urgent
+
+    def release(self):
+        """Release the lock"""
+        with self.cond:
+            self.owned = False
+            self.cond.notify_all()
+
+    def locked(self):
+        """True if the lock is taken or an urgent user is waiting for it"""
+        return self.owned or self.urgentWaiters > 0
+
+    @contextlib.contextmanager
+    def urgent(self):
+        """Context manager, acquiring the lock with priority"""
+        self.acquire(urgent=True)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
 #``````````````````Constants
-Threadlock = threading.Lock()
+Threadlock = PriorityLock()
 OK = 0
 NotOK = -1
 IF_CHANGED =True
-ElapsedTime = {}
+ElapsedTime = {}# last time of each stage
+Stages = ('trigger_detection', 'preamble', 'query_wf', 'acquire_wf', 'publish_wf')
 NDIVSX = 10# number of horizontal divisions of the scope display
 NDIVSY = 10# number of vertical divisions
+WireFormats = {'INT,16':'i2', 'INT,8':'i1', 'REAL,32':'f4'}# FORMat:DATA: sample type
+CodesPerDiv = {1:25., 2:6400.}# raw codes per vertical division of INT,8 and INT,16
 #,,,,,,,,,,,,,,,,,,
 class C_():
     """Namespace for module properties"""
     scope = None
+    idn = ''
     scpi = {}# {pvName:SCPI} map
     setterMap = {}
     PvDefs = []
@@ -115,13 +299,56 @@ class C_():
     exceptionCount = {}
     numacq = 0
     triggersLost = 0
+    scopeAcqCount = 0
+    deadTime = 0.# time, when the scope was not armed
+    lastRates = None# (time, triggersLost, deadTime) of previous rate update
+    trigTimes = collections.deque(maxlen=16)# times of the latest trigger detections
+    lastPeriodic = 0.# time of the latest periodic update
+    settingsPollTime = 0.# duration of the latest settings poll
+    fixedSleep = None# sleep PV of the operator, saved in Adaptive pollMode
+    settingsRequest = threading.Event()# set by periodicUpdate for settings_worker
     trigTime = 0
-    previousScopeParametersQuery = ''
+    settingsCache = {}# {pvName:last reply of the scope}
+    settingsCycle = 0
+    criticalSettings = []# settings, which define the acquisition
+    slowSettings = set()# static settings, read every slowPollEvery updates
     channelsTriggered = []
     xorigin = 0.
     xincrement = 0.
     npoints = 0
+    wireDtype = np.dtype('<i2')# type of the transferred samples
     ypars = None
+    previewAxisKey = None
+    tAxisKey = ()# horizontal parameters of the posted tAxis, None: empty
+    tAxisConnected = False
+    srqEnabled = False
+    acqQueue = None
+    bufferPool = queue.LifoQueue()
+    floatBuffers = threading.local()
+    refsLock = threading.Lock()
+    writeLock = threading.Lock()
+    pendingWrites = {}# {pvName:value} of setter writes, not yet sent
+    queueDrops = 0
+    statPool = None# process pool for the statistics of the shared buffers
+    sharedMemory = None# (SharedMemory, address) of the buffer sets, shared with statPool
+    retiredMemory = []# replaced SharedMemory blocks, closed when no longer used
+    accum = {}# {channel:accumulators}, see accumulate()
+    accumLock = threading.Lock()
+    accumShots = 0
+    submitSeq = 0# sequence number of the next record, submitted to the workers
+    publishSeq = 0# sequence number of the next record to publish
+    publishTurn = threading.Condition()
+    accumPublished = 0.
+    history = None# ring of the latest acquisitions, see allocate_history()
+    historyLock = threading.Lock()
+    recQueue = None
+    recording = False
+    recordBytes = 0
+    recordDrops = 0
+    lastRecordRate = None# (time, recordBytes) of previous rate update
+    timingSamples = {stage:collections.deque(maxlen=1000) for stage in Stages}
+    timingTotals = {stage:[0, 0.] for stage in Stages}# count, sum
+    timingLock = threading.Lock()# record_time is called by several threads
 #``````````````````Setters````````````````````````````````````````````````````
 def scopeCmd(cmd):
     """Send command to scope, return reply if any."""
@@ -151,8 +378,8 @@ def serverStateChanged(newState:str):
         edev.printi('start_device called')
         configure_scope()
         adopt_local_setting()
-        C_.scope.write(':RUN')
-        wait_for_scopeReady()
+        with Threadlock:
+            arm_scope()
 
     elif newState == 'Stop':
         edev.printi('stop_device called')
@@ -190,6 +417,92 @@ def set_trigger(value, *_):
             C_.scope.write('TRIGger:FORCe')
         edev.publish('trigger','Trigger')
 
+def set_trigWait(value, *_):
+    """setter for the trigWait PV"""
+    edev.printv(f'set_trigWait: {value}')
+    edev.publish('trigWait', value)
+    with Threadlock:
+        if edev.serverState().startswith('Start'):
+            C_.scope.write(':STOP')
+            arm_scope()
+
+def set_timingWindow(value, *_):
+    """setter for the timingWindow PV"""
+    C_.timingSamples = {stage:collections.deque(maxlen=int(value))
+        for stage in Stages}
+    edev.publish('timingWindow', value)
+
+def set_nSegments(value, *_):
+    """setter for the nSegments PV"""
+    n = int(value)
+    if n > 1:
+        cmds = [f'ACQuire:SEGMented:STATe ON;:ACQuire:COUNt {n}']
+        for ch in range(1, pargs.channels+1):
+            cmds.append(f'CHANnel{ch}:HISTory:STARt {1-n};:CHANnel{ch}:HISTory:STOP 0')
+        cmds.append('EXPort:WAVeform:DLOGging ON')
+    else:
+        cmds = ['ACQuire:SEGMented:STATe OFF;:EXPort:WAVeform:DLOGging OFF']
+    scopeCmd(';:'.join(cmds))
+    edev.publish('nSegments', n)
+    with Threadlock:
+        if edev.serverState().startswith('Start'):
+            C_.scope.write(':STOP')
+            arm_scope()
+
+def set_recordCtrl(value, *_):
+    """setter for the recordCtrl PV"""
+    start = str(value) == 'Start'
+    if start and not C_.recording:
+        try:
+            ring = open_recording()
+        except (OSError, ValueError) as e:
+            edev.printe(f'Could not start recording: {e}')
+            edev.publish('recordCtrl', 'Stop')
+            return
+        if C_.recQueue is None:
+            C_.recQueue = queue.Queue(maxsize=pargs.queueSize)
+            threading.Thread(target=recording_worker, daemon=True).start()
+        C_.recQueue.put(ring)
+    elif not start and C_.recording:
+        C_.recQueue.put(None)
+    C_.recording = start
+    edev.publish('recordCtrl', value)
+
+def set_accumulator(value, pv, *_):
+    """setter for the PVs of the averaging and persistence accumulators.
+    Changing any of them resets the accumulators."""
+    if pv.name != 'accumReset':
+        edev.publish(pv.name, value)
+    reset_accumulators()
+    edev.publish('accumReset', 'Reset')
+
+def set_historyDepth(value, *_):
+    """setter for the historyDepth PV"""
+    edev.publish('historyDepth', value)
+    allocate_history()
+
+def set_historyFetch(value, *_):
+    """setter for the historyFetch PV"""
+    if str(value) == 'Fetch!':
+        fetch_history()
+    edev.publish('historyFetch', 'Fetch')
+
+def set_measMode(value, *_):
+    """setter for the measMode PV"""
+    configure_measurements(str(value) == 'Measurements')
+    edev.publish('measMode', value)
+
+def set_dataFormat(value, *_):
+    """setter for the dataFormat PV"""
+    edev.publish('dataFormat', value)
+    configure_format()
+
+def set_roi(value, pv, *_):
+    """setter for the roiStart and roiLength PVs"""
+    edev.publish(pv.name, value)
+    configure_roi()
+    update_scopeParameters(set(C_.criticalSettings))
+
 def set_recLengthS(value, *_):
     """setter for the recLengthS PV"""
     edev.printv(f'set_recLengthS: {value}')
@@ -199,21 +512,110 @@ def set_recLengthS(value, *_):
     update_scopeParameters()
 
 def set_scpi(value, pv, *_):
-    """setter for SCPI-associated PVs"""
-    print(f'set_scpi({value},{pv.name})')
+    """setter for SCPI-associated PVs. The writes are queued and sent to
+    the scope by flush_writes, the later write to the same PV supersedes
+    the pending one."""
+    edev.printv(f'set_scpi({value},{pv.name})')
     scpi = C_.scpi.get(pv.name,None)
     if scpi is None:
         edev.printe(f'No SCPI defined for PV {pv.name}')
         return
-    scpi = scpi.replace('<n>',pv.name[2])# replace <n> with channel number
-    print(f'set_scpi: {scpi} {value}')
-    scpi += f' {value}' if pv.writable else '?'
-    edev.printv(f'set_scpi command: {scpi}')
-    reply = scopeCmd(scpi)
-    if reply is not None:
-        edev.publish(pv.name, reply)
+    if not pv.writable:
+        reply = scopeCmd(scpi+'?')
+        if reply is not None:
+            edev.publish(pv.name, reply)
+        return
+    with C_.writeLock:
+        C_.pendingWrites.pop(pv.name, None)# keep order of the latest writes
+        C_.pendingWrites[pv.name] = value
     edev.publish(pv.name, value)
 
+def flush_writes():
+    """Send all pending setter writes in one message, then read back the
+    written settings and the error queue in one query."""
+    with C_.writeLock:
+        if not C_.pendingWrites:
+            return
+        writes, C_.pendingWrites = C_.pendingWrites, {}
+    cmds = ';:'.join([f'{C_.scpi[pvname]} {v}' for pvname,v in writes.items()])
+    readBack = '?;:'.join([C_.scpi[pvname] for pvname in writes]) + '?;:SYSTem:ERRor?'
+    edev.printv(f'flush_writes: {cmds}')
+    try:
+        with Threadlock:
+            C_.scope.write(':'+cmds)
+            values = C_.scope.query(':'+readBack).split(';')
+    except visa.errors.VisaIOError:
+        handle_exception(f'in flush_writes {cmds}')
+        return
+    error = values.pop()
+    if not error.startswith('0'):
+        edev.printw(f'SCPI error after writing {list(writes)}: {error}')
+        edev.publish('status', f'ERR: {error}')
+    ct = time.time()
+    for pvname,v in zip(writes, values):
+        try:
+            edev.publish(pvname, setting_value(edev.pvobj(pvname), v), IF_CHANGED, ct)
+        except ValueError:
+            edev.printe(f'ValueError converting {v} for PV {pvname}')
+            continue
+        C_.settingsCache[pvname] = v
+    update_scopeParameters(set(writes))
+
+#``````````````````Timing statistics``````````````````````````````````````````
+def record_time(stage, seconds):
+    """Record time spent in a stage of the acquisition"""
+    with C_.timingLock:
+        ElapsedTime[stage] = seconds
+        C_.timingSamples[stage].append(seconds)
+        totals = C_.timingTotals[stage]
+        totals[0] += 1
+        totals[1] += seconds
+
+def timing_statistics():
+    """Return {statistic:[value per stage]} over the sliding window"""
+    r = {'Count':[], 'Mean':[], 'P50':[], 'P95':[], 'P99':[], 'Max':[]}
+    for stage in Stages:
+        with C_.timingLock:
+            samples = np.array(C_.timingSamples[stage])
+        if len(samples) == 0:
+            samples = np.zeros(1)
+            r['Count'].append(0)
+        else:
+            r['Count'].append(len(samples))
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        for key,v in zip(('Mean','P50','P95','P99','Max'),
+                (samples.mean(), p50, p95, p99, samples.max())):
+            r[key].append(round(float(v), 6))
+    return r
+
+def publish_timing():
+    """Publish timing statistics and write them to Prometheus file"""
+    stats = timing_statistics()
+    for key, values in stats.items():
+        edev.publish(f'timing{key}', values)
+    if pargs.prometheus:
+        write_prometheus(stats)
+
+def write_prometheus(stats):
+    """Write timing statistics to file in Prometheus text format"""
+    name = 'epicsdev_rohde_stage_seconds'
+    lines = [f'# HELP {name} Time spent in acquisition stages',
+        f'# TYPE {name} summary']
+    for i, stage in enumerate(Stages):
+        labels = f'prefix="{pargs.prefix}",stage="{stage}"'
+        for q, key in (('0.5','P50'), ('0.95','P95'), ('0.99','P99')):
+            lines.append(f'{name}{{{labels},quantile="{q}"}} {stats[key][i]}')
+        count, total = C_.timingTotals[stage]
+        lines.append(f'{name}_sum{{{labels}}} {total}')
+        lines.append(f'{name}_count{{{labels}}} {count}')
+    tmp = pargs.prometheus + '.tmp'
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, pargs.prometheus)
+    except OSError as e:
+        edev.printe(f'Could not write {pargs.prometheus}: {e}')
+
 #``````````````````Instrument communication functions`````````````````````````
 def query(pvnames, explicitSCPIs=None):
     """Execute query request of the instrument for multiple PVs"""
@@ -229,10 +631,38 @@ def query(pvnames, explicitSCPIs=None):
 def configure_scope():
     """Send commands to configure data transfer"""
     edev.printi('configure_scope')
+    configure_format()
+    configure_roi()
+
+def configure_format():
+    """Set the transfer format of the waveforms. The sample type is derived
+    from the format and byte order, reported back by the scope."""
     with Threadlock:
-        # R&S specific configuration for binary data transfer
-        C_.scope.write(":FORMat:DATA INT,16")  # 16-bit integer data
-        C_.scope.write(":FORMat:BORDer NORM")  # Normal byte order
+        C_.scope.write(f':FORMat:DATA {str(edev.pvv("dataFormat"))}')
+        C_.scope.write(':FORMat:BORDer NORM')# LSB first
+        fmt, order = [i.strip().upper() for i in
+            C_.scope.query('FORMat:DATA?;:FORMat:BORDer?').split(';')]
+        if fmt not in WireFormats:
+            edev.printw(f'Unsupported data format {fmt}, INT,16 is used')
+            C_.scope.write(':FORMat:DATA INT,16')
+            fmt = 'INT,16'
+        byteOrder = '>' if order.startswith(('MSB','SWAP')) else '<'
+        dtype = np.dtype(byteOrder + WireFormats[fmt])
+        changed = dtype != C_.wireDtype
+        C_.wireDtype = dtype
+    edev.publish('dataFormat', fmt, IF_CHANGED)
+    edev.printi(f'Data format: {fmt}, samples: {dtype.str}')
+    if changed:
+        allocate_buffers()
+
+def configure_roi():
+    """Set the range of the record, transferred by CHANnel<n>:DATA?"""
+    start, length = float(edev.pvv('roiStart')), float(edev.pvv('roiLength'))
+    if length > 0.:
+        scopeCmd(f'EXPort:WAVeform:SCOPe MANual;:EXPort:WAVeform:STARt {start}'
+            f';:EXPort:WAVeform:STOP {start + length}')
+    else:
+        scopeCmd('EXPort:WAVeform:SCOPe WFM')
 
 def wait_for_scopeReady():
     """Wait for scope to be in RUN state after acquisition"""
@@ -245,35 +675,149 @@ def wait_for_scopeReady():
         edev.set_server('Stop')
         edev.printw(f'Scope still stopped {attempt*0.1} seconds after acquisition, Server will be stopped')
 
-def update_scopeParameters():
-    """Update scope timing PVs"""
-    # Query parameters from the scope
-    xscpi = (":TIMebase:RANGe?;:ACQuire:POINts?;:CHAN1:STATe?;"
-                ":CHAN2:STATe?;:CHAN3:STATe?;:CHAN4:STATe?;:TRIGger:LEVel?")
-    with Threadlock:
-        r = C_.scope.query(xscpi)
-    if r != (C_.previousScopeParametersQuery):
-        edev.printi(f'Scope parameters changed: {r}')
-        l = r.split(';')
-        timeRange = float(l[0])  # Total time range
-        C_.npoints = int(l[1])
-        C_.xincrement = timeRange / C_.npoints
-        C_.xorigin = -timeRange / 2.0  # R&S typically centers around trigger
-        taxis = np.arange(0, C_.npoints) * C_.xincrement + C_.xorigin
-        edev.publish('tAxis', taxis)
-        edev.publish('recLengthR', C_.npoints, IF_CHANGED)
-        edev.publish('timePerDiv', timeRange/NDIVSX, IF_CHANGED)
-        edev.publish('samplingRate', 1./C_.xincrement, IF_CHANGED)
-        C_.channelsTriggered = []
-        for ch in range(pargs.channels):
-            state = l[ch+2]
-            # R&S returns '1' or '0' for state
-            state_str = 'ON' if state == '1' else 'OFF'
-            edev.publish(f'c{ch+1:02}OnOff', state_str, IF_CHANGED)
-            if state == '1':
-                C_.channelsTriggered.append(ch+1)
-        edev.publish('trigLevel', float(l[6]), IF_CHANGED)
-    C_.previousScopeParametersQuery = r
+def enable_srq():
+    """Enable queuing of service request events. The scope will assert SRQ
+    when the operation complete bit is set in the event status register.
+    Returns False if the transport does not support it."""
+    if C_.srqEnabled:
+        return True
+    try:
+        C_.scope.enable_event(constants.EventType.service_request,
+            constants.EventMechanism.queue)
+    except (NotImplementedError, VisaIOError) as e:
+        edev.printv(f'enable_event failed: {e}')
+        return False
+    C_.scope.write('*ESE 1;*SRE 32')# OPC -> ESB -> SRQ
+    C_.srqEnabled = True
+    return True
+
+def trigger_wait_mode():
+    """Return effective trigWait mode"""
+    mode = str(edev.pvv('trigWait'))
+    if mode == 'Poll' and edev.pvv('nSegments') > 1:
+        return 'OPC'# segmented acquisition is always single
+    return mode
+
+def arm_scope():
+    """Restart acquisition according to trigWait mode.
+    Should be called with Threadlock acquired."""
+    mode = trigger_wait_mode()
+    if mode == 'SRQ' and not enable_srq():
+        edev.printw('Service request is not supported by the transport, using OPC')
+        mode = 'OPC'
+        edev.publish('trigWait', mode)
+    if mode == 'Poll':
+        C_.scope.write(':RUN')
+        wait_for_scopeReady()
+    else:# OPC, SRQ: the operation complete bit is set when the run is finished
+        C_.scope.query('*ESR?')# clear event status register
+        C_.scope.write(':SINGle;*OPC')
+
+def wait_for_trigger_event(mode):
+    """Block until the armed single acquisition is complete or trigTimeout
+    expired. Should be called with Threadlock acquired.
+    Returns True if acquisition is complete."""
+    timeout = int(edev.pvv('trigTimeout')*1000)
+    if mode == 'SRQ':
+        try:
+            C_.scope.wait_on_event(constants.EventType.service_request, timeout)
+        except VisaIOError as e:
+            if e.error_code == constants.StatusCode.error_timeout:
+                return False
+            raise
+        C_.scope.read_stb()# clear the service request
+        return True
+
+    # OPC: the operation complete bit of the event status register is polled
+    # in short slices. A blocking *OPC? cannot be cancelled on raw sockets,
+    # its late reply would be taken for the reply to the next query.
+    Slice = 0.005# S
+    deadline = timer() + timeout/1000.
+    while True:
+        if int(C_.scope.query('*ESR?')) & 1:
+            return True
+        if timer() >= deadline:
+            break
+        time.sleep(Slice)
+    # the armed acquisition, e.g. a segmented one, which needs longer than
+    # trigTimeout, keeps running; re-arm only if the scope stopped
+    state = C_.scope.query(':TRIGger:STATe?')
+    if state in ('COMP', 'COMPLETE'):
+        return True
+    if state == 'STOP':
+        edev.printw('Scope stopped before the acquisition was complete, re-armed')
+        C_.scope.write(':SINGle;*OPC')
+    elif edev.pvv('nSegments') > 1:
+        edev.printv(f"Segmented acquisition: {C_.scope.query('ACQuire:CURRent?')}"
+            f" of {edev.pvv('nSegments')} triggers")
+    return False
+
+def time_axis(npoints, xincrement, xorigin, chunk=1000000):
+    """Return float32 time axis. It is calculated in float64 chunks to keep
+    the precision and temporary memory low."""
+    taxis = np.empty(npoints, dtype=np.float32)
+    for i in range(0, npoints, chunk):
+        n = min(chunk, npoints - i)
+        taxis[i:i+n] = np.arange(i, i+n) * xincrement + xorigin
+    return taxis
+
+def publish_tAxis():
+    """Materialize and publish tAxis, if the horizontal parameters have
+    changed since it was published last time. Without clients the outdated
+    axis is replaced by an empty one, the first client then gets the
+    current axis, published asynchronously."""
+    key = (C_.npoints, C_.xincrement, C_.xorigin)
+    if key == C_.tAxisKey:
+        return
+    if not C_.tAxisConnected:
+        if C_.tAxisKey is not None:
+            C_.tAxisKey = None
+            edev.publish('tAxis', np.zeros(0, dtype=np.float32))
+        return
+    C_.tAxisKey = key
+    edev.printv(f'Publishing tAxis of {C_.npoints} points')
+    edev.publish('tAxis', time_axis(*key))
+
+def tAxis_connected(*_):
+    """Called when first client connects to tAxis"""
+    C_.tAxisConnected = True
+    publish_tAxis()
+
+def tAxis_disconnected(*_):
+    """Called when last client disconnects from tAxis"""
+    C_.tAxisConnected = False
+
+def update_scopeParameters(changed=None):
+    """Update scope timing PVs. The acquisition-critical settings are re-read
+    from the scope, unless the names of the changed settings are provided."""
+    if changed is None:
+        changed = poll_settings(C_.criticalSettings)
+    if C_.npoints != 0 and not changed.intersection(C_.criticalSettings):
+        return
+    edev.printi(f'Scope parameters changed: {sorted(changed)}')
+    timeRange = float(C_.settingsCache['timePerDiv'])*NDIVSX
+    recLength = int(float(C_.settingsCache['recLengthR']))
+    xincrement = timeRange / recLength
+    xorigin = -timeRange / 2.0  # R&S typically centers around trigger
+    # the transferred points: the region of interest or the full record
+    i0, i1 = 0, recLength
+    start, length = float(edev.pvv('roiStart')), float(edev.pvv('roiLength'))
+    if length > 0.:
+        i0, i1 = [min(max(round((t - xorigin)/xincrement), 0), recLength)
+            for t in (start, start + length)]
+    npoints = max(i1 - i0, 1)
+    if npoints != C_.npoints:
+        C_.npoints = npoints
+        allocate_buffers()
+        allocate_history()
+    C_.xincrement = xincrement
+    C_.xorigin = xorigin + i0*xincrement
+    edev.publish('xOrigin', C_.xorigin, IF_CHANGED)
+    edev.publish('xIncrement', C_.xincrement, IF_CHANGED)
+    publish_tAxis()
+    edev.publish('samplingRate', 1./C_.xincrement, IF_CHANGED)
+    C_.channelsTriggered = [ch+1 for ch in range(pargs.channels)
+        if C_.settingsCache[f'c{ch+1:02}OnOff'] == '1']
 
 def init_visa():
     '''Init VISA interface to device'''
@@ -292,6 +836,9 @@ def init_visa():
         sys.exit(1)
     
     C_.scope.timeout = 5000 # ms - R&S may need more time
+    sock = scope_socket()
+    if sock is not None:# do not delay short commands, following each other
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     C_.scope.read_termination = '\n'
     C_.scope.write_termination = '\n'
     try:
@@ -309,6 +856,7 @@ def init_visa():
             print('You may need to check VXI or network settings on the instrument.')
         sys.exit(1)
     edev.printi(f'IDN: {idn}')
+    C_.idn = idn.strip()
     if not ('ROHDE' in idn.upper() or 'SCHWARZ' in idn.upper() or 'R&S' in idn.upper()):
         print('WARNING: instrument may not be a Rohde&Schwarz device')
         print(f'IDN: {idn}')
@@ -331,55 +879,88 @@ def handle_exception(where):
         C_.scope.write('*CLS')
     return -1
 
-def adopt_local_setting():
-    """Read scope setting and update PVs"""
-    edev.printi('adopt_local_setting')
+def setting_value(pv, reply:str):
+    """Convert scope reply to the type of the PV value"""
+    if pv.discrete:
+        # R&S returns '1' or '0' for ON/OFF
+        return {'1':'ON', '0':'OFF'}.get(reply, reply)
+    return type(pv.current().raw.value)(reply)
+
+def poll_settings(names):
+    """Read the settings of the named SCPI PVs in one query, publish the
+    ones which differ from the settings cache. Return set of changed names."""
+    if not names:
+        return set()
+    if len(names) == len(C_.scpi):
+        query = C_.readSettingQuery
+    else:
+        query = '?;:'.join([C_.scpi[pvname] for pvname in names]) + '?'
+    edev.printvv(f'poll_settings: {query}')
+    with Threadlock:
+        values = C_.scope.query(query).split(';')
+    if len(names) != len(values):
+        l = min(len(names),len(values))
+        raise ValueError(f'ReadSetting failed for {names[l]}')
     ct = time.time()
-    nothingChanged = True
-    try:
-        edev.printvv(f'readSettingQuery: {C_.readSettingQuery}')
+    changed = set()
+    for pvname,v in zip(names, values):
+        if C_.settingsCache.get(pvname) == v:
+            continue
+        pv = edev.pvobj(pvname)
+        try:
+            value = setting_value(pv, v)
+        except ValueError as e:
+            raise ValueError(f'Could not convert {v} for PV {pvname}') from e
+        edev.printv(f'posting {pvname}={value}')
+        pv.post(value, timestamp=ct)
+        C_.settingsCache[pvname] = v
+        changed.add(pvname)
+    return changed
+
+def settings_due():
+    """Return names of the settings to be read in this periodic update.
+    The slow settings are read every slowPollEvery updates. With settingsCheck
+    = ESR, they are also read when the event status register of the scope
+    reports an event."""
+    C_.settingsCycle += 1
+    slow = C_.settingsCycle % max(int(edev.pvv('slowPollEvery')), 1) == 0
+    if not slow and str(edev.pvv('settingsCheck')) == 'ESR'\
+            and trigger_wait_mode() == 'Poll':# otherwise the ESR is consumed by the trigger wait
         with Threadlock:
-            values = C_.scope.query(C_.readSettingQuery).split(';')
-        edev.printvv(f'parnames: {C_.scpi.keys()}')
-        edev.printvv(f'C_.readSettingQuery: {C_.readSettingQuery}')
-        edev.printvv(f'values: {values}')
-        if len(C_.scpi) != len(values):
-            l = min(len(C_.scpi),len(values))
-            edev.printe(f'ReadSetting failed for {list(C_.scpi.keys())[l]}')
-            sys.exit(1)
-        for parname,v in zip(C_.scpi, values):
-            pv = edev.pvobj(parname)
-            pvValue = pv.current()
-            if pv.discrete:
-                pvValue = str(pvValue)
-            else:
-                try:
-                    v = type(pvValue.raw.value)(v)
-                except ValueError:
-                    edev.printe(f'ValueError converting {v} to {type(pvValue.raw.value)} for PV {parname}')
-                    sys.exit(1)
-            valueChanged = pvValue != v
-            if valueChanged:
-                edev.printv(f'posting {pv.name}={v}')
-                pv.post(v, timestamp=ct)
-                nothingChanged = False
+            slow = int(C_.scope.query('*ESR?')) != 0
+    return [pvname for pvname in C_.scpi
+        if slow or pvname not in C_.slowSettings]
 
+def adopt_local_setting():
+    """Read all scope settings and update PVs"""
+    edev.printi('adopt_local_setting')
+    try:
+        changed = poll_settings(list(C_.scpi))
     except visa.errors.VisaIOError as e:
         edev.printe('VisaIOError in adopt_local_setting:'+str(e))
-    if nothingChanged:
+        return
+    except ValueError as e:
+        edev.printe(str(e))
+        sys.exit(1)
+    if not changed:
         edev.printi('Local setting did not change.')
+    update_scopeParameters(changed)
 
 #,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,
 #``````````````````Acquisition-related functions``````````````````````````````
 def trigger_is_detected():
     """check if scope was triggered"""
     ts = timer()
+    mode = trigger_wait_mode()
     try:
-        with Threadlock:
-            trigStatus = C_.scope.query(':TRIGger:STATe?')
-            if trigStatus == 'STOP':
-                edev.set_server('Stop')
-                edev.printw('Scope was stopped externally. Server stopped.')
+        with Threadlock.urgent():
+            if mode == 'Poll':
+                trigStatus = C_.scope.query(':TRIGger:STATe?')
+                if trigStatus == 'STOP':
+                    edev.set_server('Stop')
+                    edev.printw('Scope was stopped externally. Server stopped.')
+            else:
+                trigStatus = 'COMP' if wait_for_trigger_event(mode) else 'WAIT'
     except visa.errors.VisaIOError as e:
         edev.printe(f'VisaIOError in query for trigger: {e}')
         for exc in C_.exceptionCount:
@@ -409,75 +990,817 @@ def trigger_is_detected():
     # trigger detected
     C_.numacq += 1
     C_.trigTime = time.time()
-    ElapsedTime['trigger_detection'] = round(timer() - ts, 6)
+    C_.trigTimes.append(timer())
+    record_time('trigger_detection', timer() - ts)
     edev.printv(f'Trigger detected {C_.numacq}')
     return True
 
 #``````````````````Acquisition-related functions``````````````````````````````
+def query_preamble(channels, nSegments):
+    """Query the number of acquisitions since the scope was armed, vertical
+    scale and offset of the channels and, for segmented acquisition,
+    relative times of the segments. The segment times are queried in
+    batches of SegmentsPerQuery, the first one in the same round trip.
+    Returns (acquisitions, [(scale, offset)], [segment times])."""
+    SegmentsPerQuery = 500
+    ch = channels[0]
+    history = [f'CHANnel{ch}:HISTory:CURRent {-k};:CHANnel{ch}:HISTory:TSRelative?'
+        for k in range(nSegments-1, -1, -1)] if nSegments > 1 else []
+    scpis = ['ACQuire:CURRent?']
+    scpis += [f'CHANnel{ch}:SCALe?;:CHANnel{ch}:OFFSet?' for ch in channels]
+    scpis += history[:SegmentsPerQuery]
+    r = [float(i) for i in C_.scope.query(';:'.join(scpis)).split(';')]
+    nscales = 1 + 2*len(channels)
+    segmentTimes = r[nscales:] if nSegments > 1 else [0.]
+    for i in range(SegmentsPerQuery, len(history), SegmentsPerQuery):
+        reply = C_.scope.query(';:'.join(history[i:i+SegmentsPerQuery]))
+        segmentTimes += [float(v) for v in reply.split(';')]
+    return int(r[0]), list(zip(r[1:nscales:2], r[2:nscales:2])), segmentTimes
+
+def configure_measurements(enable):
+    """Enable or disable the measurement slots of the scope for the
+    channel-statistic PVs: slot 2n-1 measures mean and 2n peak-to-peak of
+    channel n."""
+    cmds = []
+    for ch in range(1, pargs.channels+1):
+        for slot, main in zip(measurement_slots(ch), ('MEAN','PDELta')):
+            if enable:
+                cmds.append(f'MEASurement{slot}:SOURce C{ch};:MEASurement{slot}:MAIN {main}'
+                    f';:MEASurement{slot}:ENABle ON')
+            else:
+                cmds.append(f'MEASurement{slot}:ENABle OFF')
+    scopeCmd(';:'.join(cmds))
+
+def measurement_slots(ch):
+    """Measurement slots for mean and peak-to-peak of the channel"""
+    return 2*ch - 1, 2*ch
+
+def query_measurements(channels):
+    """Query, in one round trip, the number of acquisitions since the scope
+    was armed and the measurement results of the channels.
+    Returns (acquisitions, {channel:(mean, peak2peak)})."""
+    scpis = ['ACQuire:CURRent?']
+    for ch in channels:
+        scpis += [f'MEASurement{slot}:RESult:ACTual?' for slot in measurement_slots(ch)]
+    r = [float(i) for i in C_.scope.query(';:'.join(scpis)).split(';')]
+    return int(r[0]), {ch:(r[1+2*i], r[2+2*i]) for i,ch in enumerate(channels)}
+
+def measurements_mode():
+    """True if c<n>Mean and c<n>Peak2Peak are measured by the scope.
+    Segmented acquisitions are always processed from the waveforms."""
+    return str(edev.pvv('measMode')) == 'Measurements' and edev.pvv('nSegments') == 1
+
+def full_transfer(count):
+    """True if the full waveforms of the acquisition count are published.
+    In Measurements mode the waveforms are transferred only in this case."""
+    fullEvery = edev.pvv('measFullEvery' if measurements_mode() else 'fullEvery')
+    return fullEvery != 0 and count % fullEvery == 0
+
+def scope_socket():
+    """Return the socket of a raw-socket resource, if it can be read
+    directly, otherwise None."""
+    try:
+        session = C_.scope.visalib.sessions[C_.scope.session]
+        sock = session.interface
+        if isinstance(sock, socket.socket) and not session._pending_buffer:
+            return sock
+    except (AttributeError, KeyError, TypeError):
+        pass
+    return None
+
+def resync_scope():
+    """Discard unread replies after an interrupted query or transfer, so
+    they do not corrupt the next query. A raw socket is drained until the
+    scope is silent, other transports are cleared by the device clear.
+    Should be called with Threadlock acquired."""
+    Quiet = 0.2# S of silence, after which the socket is considered drained
+    try:
+        session = C_.scope.visalib.sessions[C_.scope.session]
+        sock = session.interface
+    except (AttributeError, KeyError, TypeError):
+        sock = None
+    if not isinstance(sock, socket.socket):
+        C_.scope.clear()
+        return
+    pending = getattr(session, '_pending_buffer', None)
+    if pending is not None:
+        pending.clear()
+    savedTimeout = sock.gettimeout()
+    sock.settimeout(Quiet)
+    ndrained = 0
+    try:
+        while True:
+            b = sock.recv(1 << 20)
+            if not b:
+                raise ConnectionError('Connection closed by instrument')
+            ndrained += len(b)
+    except socket.timeout:
+        pass
+    finally:
+        sock.settimeout(savedTimeout)
+    edev.printw(f'Discarded {ndrained} bytes of unread replies')
+
+def recv_into(sock, view):
+    """Receive exactly len(view) bytes from socket into memoryview"""
+    pos = 0
+    while pos < len(view):
+        n = sock.recv_into(view[pos:])
+        if n == 0:
+            raise ConnectionError('Connection closed by instrument')
+        pos += n
+
+def read_block(buffers, ch, sock):
+    """Read one IEEE-488.2 definite-length block of channel ch. If sock is
+    provided, the block is received directly into the channel buffer.
+    Returns array of C_.wireDtype samples."""
+    if sock is None:
+        read = C_.scope.read_bytes
+    else:
+        def read(n):
+            b = bytearray(n)
+            recv_into(sock, memoryview(b))
+            return bytes(b)
+    header = read(2)
+    if header[:1] != b'#' or header[1:2] == b'0':
+        raise ValueError(f'Unsupported binary block header: {header}')
+    nbytes = int(read(int(header[1:2])))
+    dtype = C_.wireDtype
+    if sock is None:
+        waveform = np.frombuffer(read(nbytes), dtype=dtype)
+    else:
+        buf = buffers.get(ch)
+        if buf is None or buf.nbytes < nbytes or buf.dtype != dtype:
+            edev.printv(f'Reallocating buffer of channel {ch} for {nbytes} bytes')
+            buf = buffers[ch] = np.empty(nbytes//dtype.itemsize, dtype=dtype)
+        waveform = buf[:nbytes//dtype.itemsize]
+        recv_into(sock, memoryview(waveform.view(np.uint8)))
+    read(1)# ';' separator or read termination
+    return waveform
+
+def read_waveforms(channels, buffers):
+    """Read raw waveforms of the channels. In Combined mode all channels
+    are requested with one chained query and transferred in one go.
+    Raw-socket transfers are received directly into the buffers."""
+    sock = scope_socket()
+    if sock is None:
+        return _read_waveforms(channels, buffers, None)
+    savedTimeout = sock.gettimeout()
+    sock.settimeout(C_.scope.timeout/1000.)
+    try:
+        return _read_waveforms(channels, buffers, sock)
+    finally:
+        sock.settimeout(savedTimeout)
+
+def _read_waveforms(channels, buffers, sock):
+    if str(edev.pvv('readoutMode')) == 'Combined':
+        C_.scope.write(';:'.join([f'CHANnel{ch}:DATA?' for ch in channels]))
+        return [read_block(buffers, ch, sock) for ch in channels]
+    waveforms = []
+    for ch in channels:
+        C_.scope.write(f'CHANnel{ch}:DATA?')
+        waveforms.append(read_block(buffers, ch, sock))
+    return waveforms
+
+#``````````````````Waveform buffers```````````````````````````````````````````
+def allocate_buffers():
+    """(Re)create the pool of per-channel waveform buffers for C_.npoints
+    points. There are enough buffer sets for all acquisitions in the
+    processing pipeline. The pages are mapped on first use, so only the
+    buffers of enabled channels occupy memory. The pool is last-in first-out,
+    the most recently used set is reused and the others are touched only
+    when the pipeline is backed up."""
+    nsets = 1 if C_.acqQueue is None else pargs.queueSize + pargs.workers + 1
+    C_.bufferPool = queue.LifoQueue()
+    if getattr(pargs, 'statProcesses', 0) > 0:
+        allocate_sharedBuffers(nsets)
+        return
+    for _ in range(nsets):
+        C_.bufferPool.put({ch:np.empty(C_.npoints, dtype=C_.wireDtype)
+            for ch in range(1, pargs.channels+1)})
+    edev.printv(f'Allocated {nsets} buffer sets of {C_.npoints} points')
+
+def allocate_sharedBuffers(nsets):
+    """Allocate the buffer sets in a new shared memory block and start the
+    statistics process pool, if it is not running. The processes are
+    spawned once, the EPICS and p4p threads of the server cannot be used in
+    a forked child. The statistics tasks pass the block name and the
+    position of the waveform. The previous block is retired."""
+    nbytes = C_.npoints*C_.wireDtype.itemsize
+    shm = shared_memory.SharedMemory(create=True,
+        size=max(nsets*pargs.channels*nbytes, 1))
+    for i in range(nsets):
+        C_.bufferPool.put({ch:np.frombuffer(shm.buf, dtype=C_.wireDtype,
+            count=C_.npoints, offset=(i*pargs.channels + ch-1)*nbytes)
+            for ch in range(1, pargs.channels+1)})
+    retire_sharedMemory()
+    C_.sharedMemory = (shm, np.frombuffer(shm.buf, dtype=np.uint8).ctypes.data)
+    if C_.statPool is None:
+        C_.statPool = ProcessPoolExecutor(pargs.statProcesses,
+            mp_context=multiprocessing.get_context('spawn'))
+        for _ in range(pargs.statProcesses):# start the processes now
+            C_.statPool.submit(int)
+    edev.printv(f'Allocated {nsets} shared buffer sets of {C_.npoints} points,'
+        f' {pargs.statProcesses} statistics processes')
+
+def retire_sharedMemory():
+    """Unlink the current shared memory block, the statistics processes
+    do not attach it anymore, and close the retired blocks, which buffers
+    are not used anymore. The buffers of a block stay valid until they are
+    released by the pipeline."""
+    if C_.sharedMemory is not None:
+        C_.sharedMemory[0].unlink()
+        C_.retiredMemory.append(C_.sharedMemory[0])
+        C_.sharedMemory = None
+    inUse = []
+    for shm in C_.retiredMemory:
+        try:
+            shm.close()
+        except BufferError:# buffers are still referenced
+            inUse.append(shm)
+    C_.retiredMemory = inUse
+
+def stop_statistics():
+    """Shut down the statistics process pool and unlink its shared memory"""
+    if C_.statPool is None:
+        return
+    C_.statPool.shutdown()
+    C_.statPool = None
+    retire_sharedMemory()
+
+def take_buffers():
+    """Take a buffer set from the pool"""
+    try:
+        return C_.bufferPool.get_nowait()
+    except queue.Empty:
+        edev.printv('Buffer pool is empty, new buffer set will be allocated')
+        return {}
+
+def release_buffers(acq):
+    """Return the buffer set of the acquisition record to its pool. Sets of
+    the pool, which was replaced after npoints change, are discarded.
+    Sets, shared with the recording, are returned by the last user."""
+    refs = acq.get('refs')
+    if refs is not None:
+        with C_.refsLock:
+            refs[0] -= 1
+            if refs[0] > 0:
+                return
+    acq['pool'].put(acq['buffers'])
+
+def count_lost_triggers(scopeAcqs, nread):
+    """Update acquisition counters. The acquisition counter of the scope
+    restarts when it is armed, all acquisitions but the nread latest ones
+    were not read out."""
+    C_.scopeAcqCount += scopeAcqs
+    C_.triggersLost += max(scopeAcqs - nread, 0)
+
+def split_segments(acq):
+    """Generate records of individual triggers of segmented acquisition
+    record. They are views into the buffer set of acq, which is released
+    with acq, after all of them are processed."""
+    n = acq['segments']
+    if n <= 1:
+        yield acq
+        return
+    waveforms = [w[:len(w)//n*n].reshape(n, -1) for w in acq['waveforms']]
+    for i in range(n):
+        rec = dict(acq)
+        rec.update(time=acq['time'] + acq['segmentTimes'][i],
+            count=acq['count'] - n + 1 + i, waveforms=[w[i] for w in waveforms],
+            segments=1)
+        yield rec
+
 def acquire_waveforms():
-    """Acquire waveforms from the device and publish them."""
+    """Read raw waveforms from the device and re-arm it.
+    Should be called with Threadlock acquired.
+    Returns acquisition record for publish_waveforms()."""
     edev.printv(f'>acquire_waveform for channels {C_.channelsTriggered}')
-    edev.publish('acqCount', edev.pvv('acqCount') + 1, t=C_.trigTime)
+    nSegments = edev.pvv('nSegments')
+    edev.publish('acqCount', edev.pvv('acqCount') + nSegments, t=C_.trigTime)
     start_time = timer()
-    ElapsedTime['preamble'] = 0.
-    ElapsedTime['query_wf'] = 0.
-    ElapsedTime['publish_wf'] = 0.
+    channels = C_.channelsTriggered
+    acq = {'time':C_.trigTime, 'count':edev.pvv('acqCount'), 'channels':channels,
+        'scales':[], 'waveforms':[], 'pool':C_.bufferPool, 'buffers':take_buffers(),
+        'segments':nSegments, 'segmentTimes':[0.]*nSegments}
+    measured = measurements_mode()
+    transfer = not measured or full_transfer(acq['count'])
     
     # Stop acquisition for consistent reading
     C_.scope.write(':STOP')
     
-    for ch in C_.channelsTriggered:
+    operation = 'getting preamble'
+    try:
+        # Query acquisition counter, scale and offset for conversion
         ts = timer()
-        operation = 'getting waveform'
+        if channels and measured:
+            operation = 'getting measurements'
+            scopeAcqs, acq['measurements'] = query_measurements(channels)
+            count_lost_triggers(scopeAcqs, nSegments)
+        if channels and transfer:
+            operation = 'getting preamble'
+            scopeAcqs, acq['scales'], acq['segmentTimes']\
+                = query_preamble(channels, nSegments)
+            if not measured:
+                count_lost_triggers(scopeAcqs, nSegments)
+        record_time('preamble', timer() - ts)
+
+        # Acquire the waveform data
+        ts = timer()
+        operation = 'getting waveform data'
+        acq['waveforms'] = read_waveforms(channels, acq['buffers'])\
+            if channels and transfer else []
+        record_time('query_wf', timer() - ts)
+    except Exception as e:
+        if isinstance(e, visa.errors.VisaIOError):
+            edev.printe(f'Visa exception in {operation} for {channels}:{e}')
+        else:
+            edev.printe(f'Exception in {operation} of channels {channels}: {e}')
+        # the rest of the replies, e.g. of the chained CHANnel<n>:DATA?, is unread
         try:
-            # Select the channel
-            C_.scope.write(f'CHANnel{ch}:DATA?')
-            
-            # Query scale and offset for conversion
-            scale_query = f'CHANnel{ch}:SCALe?;:CHANnel{ch}:OFFSet?'
-            with Threadlock:
-                scale_offset = C_.scope.query(scale_query).split(';')
-            scale = float(scale_offset[0])
-            offset_display = float(scale_offset[1])
-            
-            ElapsedTime['preamble'] += timer() - ts
-            
-            # Acquire the waveform data
-            ts = timer()
-            operation = 'getting waveform data'
-            waveform = C_.scope.query_binary_values(f'CHANnel{ch}:DATA?',
-                datatype='h', container=np.array)  # signed 16-bit
-            ElapsedTime['query_wf'] += timer() - ts
-            
-            # R&S conversion: raw values typically range from -32768 to 32767
-            # The scale parameter represents volts per division
-            # For a full screen of 10 divisions with 8-bit data resolution,
-            # we divide by 25 to convert from raw ADC units to divisions
-            # (this accounts for the data range and screen divisions)
-            v = waveform.astype(float) * scale / 25.0
-            
-            # publish
-            ts = timer()
-            operation = 'publishing'
-            edev.publish(f'c{ch:02}Waveform', v, t=C_.trigTime)
-            edev.publish(f'c{ch:02}Peak2Peak', np.ptp(v), t = C_.trigTime)
-            edev.publish(f'c{ch:02}Mean', v.mean(), t = C_.trigTime)
-        except visa.errors.VisaIOError as e:
-            edev.printe(f'Visa exception in {operation} for {ch}:{e}')
-            break
+            resync_scope()
         except Exception as e:
-            edev.printe(f'Exception in {operation} of channel {ch}: {e}')
-
-        ElapsedTime['publish_wf'] += timer() - ts
+            edev.printe(f'Exception in resynchronization with the scope: {e}')
     
     # Restart acquisition
-    C_.scope.write(':RUN')
-    wait_for_scopeReady()
-    ElapsedTime['acquire_wf'] = timer() - start_time
+    arm_scope()
+    C_.deadTime += timer() - start_time
+    record_time('acquire_wf', timer() - start_time)
     edev.printvv(f'elapsedTime: {ElapsedTime}')
+    return acq
+
+def raw_to_volts(scale, offset, dtype):
+    """Return (gain, offset) for conversion of raw samples of type dtype
+    to volts: V = raw*gain + offset"""
+    if dtype.kind == 'f':# REAL,32 samples are volts
+        return 1., 0.
+    # R&S integer data: raw codes relative to the screen center, which is
+    # at the channel offset; the scale parameter represents volts per division
+    return scale / CodesPerDiv[dtype.itemsize], offset
+
+def integer_samples(waveform, scale, offset):
+    """Return raw integer samples of the waveform and their (gain, offset).
+    REAL,32 waveforms are quantized to INT,16 codes of the channel for the
+    consumers of integer samples: history, recording and persistence."""
+    if waveform.dtype.kind != 'f':
+        return waveform, raw_to_volts(scale, offset, waveform.dtype)
+    gain, v0 = raw_to_volts(scale, offset, np.dtype('<i2'))
+    raw = np.rint((waveform - v0)/gain)
+    return np.clip(raw, -32768, 32767, out=raw).astype('<i2'), (gain, v0)
+
+def minmax_decimate(a, npoints):
+    """Return min/max envelope of array a: interleaved minimums and maximums
+    of npoints//2 equal chunks, and the chunk size."""
+    nchunks = max(npoints//2, 1)
+    chunkSize = len(a)//nchunks
+    if chunkSize < 2:
+        return a, 1
+    chunks = a[:nchunks*chunkSize].reshape(nchunks, chunkSize)
+    r = np.empty((nchunks,2), dtype=a.dtype)
+    np.min(chunks, axis=1, out=r[:,0])
+    np.max(chunks, axis=1, out=r[:,1])
+    return r.ravel(), chunkSize
+
+def publish_previewAxis(npoints, chunkSize, t):
+    """Publish tAxisPreview if the horizontal setting or chunking changed"""
+    key = (npoints, chunkSize, C_.xincrement, C_.xorigin)
+    if key == C_.previewAxisKey:
+        return
+    C_.previewAxisKey = key
+    if chunkSize == 1:
+        taxis = np.arange(npoints) * C_.xincrement + C_.xorigin
+    else:# each chunk is represented by min and max at chunk start
+        taxis = np.repeat(np.arange(npoints//2) * (chunkSize*C_.xincrement)
+            + C_.xorigin, 2)
+    edev.publish('tAxisPreview', taxis, t=t)
+
+def float_buffer(n, slot=0):
+    """Return float32 scratch array of n elements, reused by the thread.
+    Arrays of different slots can be used at the same time."""
+    bufs = getattr(C_.floatBuffers, 'bufs', None)
+    if bufs is None:
+        bufs = C_.floatBuffers.bufs = {}
+    buf = bufs.get(slot)
+    if buf is None or len(buf) < n:
+        buf = bufs[slot] = np.empty(n, dtype=np.float32)
+    return buf[:n]
+
+def publish_waveforms(acq):
+    """Convert raw waveforms of the acquisition record, calculate statistics
+    and publish them, trigger by trigger for segmented acquisition. The
+    processing workers convert in parallel, but publish in order of
+    acquisition: the turn is taken after the first trigger is converted and
+    held until the last one is published, the scratch arrays of the
+    conversion are reused by the next trigger."""
+    ts = timer()
+    with contextlib.ExitStack() as turn:
+        for i, rec in enumerate(split_segments(acq)):
+            t = rec['time']
+            try:
+                updates, previewAxis = convert_waveforms(rec)
+                updates += statistics_updates(rec)
+            except Exception as e:# the turn must be taken anyway
+                edev.printe(f'Exception in processing of acquisition {rec["count"]}: {e}')
+                updates, previewAxis = [], None
+            for ch, (mean, ptp) in rec.get('measurements', {}).items():
+                updates += [(f'c{ch:02}Peak2Peak', ptp, False), (f'c{ch:02}Mean', mean, False)]
+            if i == 0:
+                turn.enter_context(publishing_turn(acq))
+            if previewAxis is not None:
+                publish_previewAxis(*previewAxis, t)
+            for name, value, ifChanged in updates:
+                edev.publish(name, value, ifChanged, t=t)
+            accumulate(rec)
+            store_history(rec)
+    release_buffers(acq)
+    record_time('publish_wf', timer() - ts)
+
+@contextlib.contextmanager
+def publishing_turn(acq):
+    """Context, entered when all acquisitions submitted to the workers
+    before acq are published"""
+    seq = acq.get('seq')
+    if seq is None:# processed in place
+        yield
+        return
+    with C_.publishTurn:
+        C_.publishTurn.wait_for(lambda: C_.publishSeq == seq)
+        try:
+            yield
+        finally:
+            C_.publishSeq += 1
+            C_.publishTurn.notify_all()
+
+def convert_waveforms(acq):
+    """Convert raw waveforms of the acquisition record.
+    Returns list of updates (pvName, value, ifChanged) and (npoints,
+    chunkSize) of the preview axis or None."""
+    updates = []
+    previewAxis = None
+    wfFormat = str(edev.pvv('wfFormat'))
+    publishFull = full_transfer(acq['count'])
+    previewPoints = edev.pvv('previewPoints')
+    for ch, (scale,offset), waveform in zip(acq['channels'], acq['scales'],
+            acq['waveforms']):
+        try:
+            gain, v0 = raw_to_volts(scale, offset, waveform.dtype)
+            isFloat = waveform.dtype.kind == 'f'# no raw samples in REAL,32
+            if previewPoints > 0:
+                preview, chunkSize = minmax_decimate(waveform, previewPoints)
+                previewAxis = (len(preview), chunkSize)
+                updates.append((f'c{ch:02}WaveformPreview',
+                    preview.astype(np.float32)*gain + v0, False))
+            if publishFull and (wfFormat != 'Raw' or isFloat):
+                v = float_buffer(len(waveform), ch)
+                np.multiply(waveform, gain, out=v)
+                v += v0
+                updates.append((f'c{ch:02}Waveform', v, False))
+            if publishFull and wfFormat != 'Float' and not isFloat:
+                updates += [(f'c{ch:02}RawScale', gain, IF_CHANGED),
+                    (f'c{ch:02}RawOffset', v0, IF_CHANGED),
+                    (f'c{ch:02}WaveformRaw', waveform, False)]
+
+        except Exception as e:
+            edev.printe(f'Exception in publishing of channel {ch}: {e}')
+    return updates, previewAxis
+
+#``````````````````Waveform statistics````````````````````````````````````````
+def submit_statistics(waveform, full, gate):
+    """Submit statistics of the waveform to the process pool, if it is in
+    the shared buffers. Return future or None."""
+    shared = C_.sharedMemory
+    if C_.statPool is None or shared is None:
+        return None
+    shm, address = shared
+    offset = waveform.ctypes.data - address
+    if not 0 <= offset <= shm.size - waveform.nbytes or not waveform.flags.c_contiguous:
+        return None
+    return C_.statPool.submit(wavestats.pool_statistics, shm.name,
+        waveform.dtype.str, offset, len(waveform), full, gate)
+
+def statistics_updates(acq):
+    """Calculate statistics of all channels of the acquisition record, in
+    parallel if the process pool is enabled.
+    Returns list of updates (pvName, value, ifChanged) in volts."""
+    updates = []
+    measured = 'measurements' in acq# Mean and Peak2Peak are measured by the scope
+    full = str(edev.pvv('statistics')) == 'Full'
+    dt = C_.xincrement
+    gate = [int((edev.pvv(pv) - C_.xorigin)/dt) if dt else 0
+        for pv in ('gateStart','gateStop')]
+    gate = [min(max(i, 0), C_.npoints) for i in gate]
+    futures = [submit_statistics(w, full, gate) for w in acq['waveforms']]
+    for ch, (scale,offset), waveform, future in zip(acq['channels'],
+            acq['scales'], acq['waveforms'], futures):
+        try:
+            r = None if future is None else future.result()
+            if r is None:# not in shared buffers, calculate in place
+                r = wavestats.waveform_statistics(waveform, full, gate)
+            gain, v0 = raw_to_volts(scale, offset, waveform.dtype)
+            n = r['n']
+            if not measured:
+                updates += [(f'c{ch:02}Peak2Peak', (r['max'] - r['min'])*gain, False),
+                    (f'c{ch:02}Mean', r['sum']/n*gain + v0, False)]
+            if not full:
+                continue
+            ms = (gain*gain*r['sumsq'] + 2.*gain*v0*r['sum'])/n + v0*v0
+            updates += [(f'c{ch:02}RMS', np.sqrt(max(ms, 0.)), False),
+                (f'c{ch:02}RiseTime', r['rise']*dt, False),
+                (f'c{ch:02}Area', (r['sum']*gain + n*v0)*dt, False),
+                (f'c{ch:02}GateIntegral', (r['gateSum']*gain + r['gateN']*v0)*dt, False)]
+        except Exception as e:
+            edev.printe(f'Exception in statistics of channel {ch}: {e}')
+    return updates
+
+
+#``````````````````Averaging and persistence``````````````````````````````````
+def reset_accumulators():
+    """Clear the averages and persistence histograms"""
+    with C_.accumLock:
+        C_.accum = {}
+        C_.accumShots = 0
+
+def accumulate(acq):
+    """Add raw waveforms of the acquisition record to the averages and
+    persistence histograms. The accumulators of a channel restart when its
+    record length, scale or data format changes."""
+    avgMode = str(edev.pvv('avgMode'))
+    persist = str(edev.pvv('persist')) == 'On'
+    if avgMode == 'Off' and not persist:
+        return
+    ntb, nab = edev.pvv('persistTimeBins'), edev.pvv('persistAmpBins')
+    weight = 1./edev.pvv('avgCount')
+    with C_.accumLock:
+        for ch, (scale,offset), waveform in zip(acq['channels'], acq['scales'],
+                acq['waveforms']):
+            gain, v0 = raw_to_volts(scale, offset, waveform.dtype)
+            a = C_.accum.get(ch)
+            key = (len(waveform), scale, offset, waveform.dtype.str)
+            if a is None or a['key'] != key:
+                a = C_.accum[ch] = {'key':key, 'gain':(gain, v0),
+                    'shots':0, 'sum':None, 'hist':None, 'tbin':None,
+                    'rawGain':gain, 'rawOffset':v0}
+            if avgMode == 'Cumulative':
+                sumType = np.int64 if waveform.dtype.kind == 'i' else np.float64
+                if a['sum'] is None or a['sum'].dtype != sumType:
+                    a['sum'] = np.zeros(len(waveform), dtype=sumType)
+                a['sum'] += waveform
+            elif avgMode == 'Exponential':
+                if a['sum'] is None or a['sum'].dtype != np.float32:
+                    a['sum'] = waveform.astype(np.float32)
+                else:# sum += (waveform - sum)*weight
+                    d = float_buffer(len(waveform))
+                    np.subtract(waveform, a['sum'], out=d)
+                    d *= weight
+                    a['sum'] += d
+            if persist:
+                if a['hist'] is None or a['hist'].shape != (ntb, nab):
+                    a['hist'] = np.zeros((ntb, nab), dtype=np.uint32)
+                    # time bin offset of each point in the flattened histogram
+                    a['tbin'] = (np.arange(len(waveform), dtype=np.int64)*ntb
+                        //len(waveform)*nab).astype(np.int32)
+                raw, (a['rawGain'], a['rawOffset']) = integer_samples(waveform,
+                    scale, offset)
+                bits = 8*raw.dtype.itemsize
+                abin = (raw.astype(np.int32) + (1 << bits-1))*nab >> bits
+                abin += a['tbin']
+                a['hist'].ravel()[:] += np.bincount(abin,
+                    minlength=ntb*nab).astype(np.uint32)
+            a['shots'] += 1
+        C_.accumShots += 1
+    now = time.time()
+    if now - C_.accumPublished >= edev.pvv('accumInterval'):
+        C_.accumPublished = now
+        publish_accumulators(avgMode, persist, now)
+
+def publish_accumulators(avgMode, persist, t):
+    """Publish the averages and persistence histograms"""
+    with C_.accumLock:
+        results = []
+        for ch, a in C_.accum.items():
+            gain, v0 = a['gain']
+            average = None
+            if a['sum'] is not None and avgMode != 'Off':
+                average = a['sum'].astype(np.float32)
+                if a['sum'].dtype != np.float32:# cumulative sum
+                    average *= gain/a['shots']
+                else:
+                    average *= gain
+                average += v0
+            hist = a['hist'].ravel().copy() if persist and a['hist'] is not None\
+                else None
+            results.append((ch, average, hist, a['rawGain'], a['rawOffset']))
+        shots = C_.accumShots
+    edev.publish('avgShots', shots, IF_CHANGED, t=t)
+    for ch, average, hist, gain, v0 in results:
+        if average is not None:
+            edev.publish(f'c{ch:02}Average', average, t=t)
+        if hist is not None:
+            edev.publish(f'c{ch:02}RawScale', gain, IF_CHANGED, t=t)
+            edev.publish(f'c{ch:02}RawOffset', v0, IF_CHANGED, t=t)
+            edev.publish(f'c{ch:02}Persistence', hist, t=t)
+
+#``````````````````History````````````````````````````````````````````````````
+def allocate_history():
+    """(Re)create the history ring for historyDepth acquisitions of
+    C_.npoints points. The pages are mapped on first use, so only the
+    channels, which were enabled, occupy memory."""
+    depth = edev.pvv('historyDepth')
+    with C_.historyLock:
+        if depth == 0 or C_.npoints == 0:
+            C_.history = None
+        else:
+            nch = pargs.channels
+            C_.history = {'data':np.empty((depth, nch, C_.npoints), dtype='<i2'),
+                'count':np.full(depth, -1, dtype=np.int64),
+                'time':np.zeros(depth), 'gain':np.zeros((depth, nch)),
+                'offset':np.zeros((depth, nch)),
+                'stored':np.zeros((depth, nch), dtype=bool), 'next':0}
+    edev.publish('historyCount', 0)
+    edev.printv(f'History allocated for {depth} acquisitions of {C_.npoints} points')
+
+def store_history(acq):
+    """Copy raw waveforms of the acquisition record to the history ring"""
+    if str(edev.pvv('historyFreeze')) == 'Freeze':
+        return
+    with C_.historyLock:
+        h = C_.history
+        if h is None:
+            return
+        slot = h['next']
+        h['next'] = (slot + 1) % len(h['count'])
+        h['count'][slot] = acq['count']
+        h['time'][slot] = acq['time']
+        h['stored'][slot] = False
+        for ch, (scale,offset), waveform in zip(acq['channels'], acq['scales'],
+                acq['waveforms']):
+            if len(waveform) != h['data'].shape[2]:
+                continue# npoints changed, the history will be reallocated
+            h['data'][slot, ch-1], (h['gain'][slot, ch-1], h['offset'][slot, ch-1])\
+                = integer_samples(waveform, scale, offset)
+            h['stored'][slot, ch-1] = True
+
+def fetch_history():
+    """Publish selected acquisitions of the history as one array per channel"""
+    first, last = edev.pvv('historyFirst'), edev.pvv('historyLast')
+    byTime = str(edev.pvv('historySelect')) == 'Time'
+    with C_.historyLock:
+        h = C_.history
+        if h is None:
+            edev.printw('History is disabled, set historyDepth')
+            return
+        key = h['time'] if byTime else h['count']
+        slots = np.nonzero((h['count'] >= 0) & (key >= first) & (key <= last))[0]
+        slots = slots[np.argsort(h['count'][slots])]
+        counts, times = h['count'][slots], h['time'][slots]
+        channels = [ch for ch in range(1, pargs.channels+1)
+            if len(slots) and h['stored'][slots, ch-1].all()]
+        data = {ch:h['data'][slots, ch-1].ravel() for ch in channels}
+        gains = {ch:h['gain'][slots, ch-1] for ch in channels}
+        offsets = {ch:h['offset'][slots, ch-1] for ch in channels}
+    edev.printi(f'Fetched {len(slots)} acquisitions of channels {channels} from history')
+    t = time.time()
+    edev.publish('historyCounts', counts, t=t)
+    edev.publish('historyTimes', times, t=t)
+    for ch in range(1, pargs.channels+1):
+        if ch not in channels:
+            data[ch], gains[ch], offsets[ch] = np.zeros(0, dtype='<i2'), [], []
+        edev.publish(f'c{ch:02}HistoryGain', gains[ch], t=t)
+        edev.publish(f'c{ch:02}HistoryOffset', offsets[ch], t=t)
+        edev.publish(f'c{ch:02}History', data[ch], t=t)
+
+def publish_historyCount():
+    """Publish number of acquisitions in the history"""
+    h = C_.history
+    edev.publish('historyCount', 0 if h is None else int((h['count'] >= 0).sum()),
+        IF_CHANGED)
+
+#``````````````````Recording``````````````````````````````````````````````````
+def open_recording():
+    """Create new recording ring file and publish its name"""
+    prefix = getattr(pargs, 'prefix', '').rstrip(':')
+    name = f"{edev.pvv('recordPath').raw.value}_{prefix}_{time.strftime('%Y%m%d_%H%M%S')}"
+    ring = recorder.RingFile(name, int(edev.pvv('recordSize')*1e6))
+    C_.recordBytes = 0
+    edev.publish('recordFile', name+'.npy')
+    edev.printi(f'Recording to {name}.npy')
+    return ring
+
+def record_acquisition(acq):
+    """Pass acquisition record to the recording thread. The buffer set of
+    the record is shared with the processing and released by the thread,
+    which is the last to use it."""
+    with C_.refsLock:
+        refs = acq.setdefault('refs', [1])
+        refs[0] += 1
+    try:
+        C_.recQueue.put_nowait(acq)
+    except queue.Full:
+        release_buffers(acq)
+        C_.recordDrops += 1
+
+def recording_worker():
+    """Thread function, writing acquisition records to the ring file.
+    Items of the queue: acquisition records, RingFile to switch to or
+    None to stop recording."""
+    ring = None
+    while True:
+        item = C_.recQueue.get()
+        if not isinstance(item, dict):
+            close_recording(ring)
+            ring = item
+            continue
+        try:
+            if ring is not None:
+                rollover = edev.pvv('recordRollover')
+                if rollover and time.time() - ring.startTime > rollover:
+                    ring.close()
+                    ring = None
+                    ring = open_recording()
+                for rec in split_segments(item):
+                    for ch, (scale,offset), waveform in zip(rec['channels'],
+                            rec['scales'], rec['waveforms']):
+                        raw, (gain, v0) = integer_samples(waveform, scale, offset)
+                        C_.recordBytes += ring.write(rec['count'], rec['time'], ch,
+                            raw, gain, v0)
+        except Exception as e:# any failure stops the recording, not the thread
+            edev.printe(f'Recording stopped: {e}')
+            close_recording(ring)
+            ring = None
+            C_.recording = False
+            edev.publish('recordCtrl', 'Stop')
+        finally:
+            release_buffers(item)
+
+def close_recording(ring):
+    """Close the ring file, if any. A failure is reported, the recording
+    thread keeps running."""
+    if ring is None:
+        return
+    try:
+        ring.close()
+    except Exception as e:
+        edev.printe(f'Closing of the recording failed: {e}')
+
+def publish_recording():
+    """Publish recording counters and the write rate since previous call"""
+    edev.publish('recordBytes', C_.recordBytes, IF_CHANGED)
+    edev.publish('recordDrops', C_.recordDrops, IF_CHANGED)
+    current = (timer(), C_.recordBytes)
+    if C_.lastRecordRate is not None:
+        dt = current[0] - C_.lastRecordRate[0]
+        rate = max(current[1] - C_.lastRecordRate[1], 0)/dt/1e6
+        edev.publish('recordRate', round(rate, 3), IF_CHANGED)
+    C_.lastRecordRate = current
+
+#``````````````````Processing pipeline````````````````````````````````````````
+def submit_acquisition(acq):
+    """Pass acquisition record to the processing workers. If the queue is
+    full, the record is dropped or the caller is blocked, depending on the
+    queuePolicy PV. Segmented acquisition is submitted as one record and
+    split into triggers by the worker, the triggers of a dropped record are
+    counted as lost."""
+    if C_.recording:
+        record_acquisition(acq)
+    if C_.acqQueue is None:# no workers, process in place
+        publish_waveforms(acq)
+        return
+    acq['seq'] = C_.submitSeq# publishing order, see publishing_turn()
+    if str(edev.pvv('queuePolicy')) == 'Block':
+        C_.acqQueue.put(acq)
+        C_.submitSeq += 1
+        return
+    try:
+        C_.acqQueue.put_nowait(acq)
+        C_.submitSeq += 1
+    except queue.Full:
+        release_buffers(acq)
+        C_.queueDrops += acq['segments']
+        C_.triggersLost += acq['segments']
+        edev.printv(f'Processing queue is full, acquisition dropped: {C_.queueDrops}')
+
+def processing_worker():
+    """Thread function, processing acquisition records from the queue."""
+    while True:
+        acq = C_.acqQueue.get()
+        publish_waveforms(acq)
+        C_.acqQueue.task_done()
+
+def start_workers():
+    """Start processing threads"""
+    if pargs.workers <= 0:
+        return
+    C_.acqQueue = queue.Queue(maxsize=pargs.queueSize)
+    for _ in range(pargs.workers):
+        threading.Thread(target=processing_worker, daemon=True).start()
+    edev.printi(f'Started {pargs.workers} processing workers, queue size: {pargs.queueSize}')
+    if C_.npoints:# buffer sets for the pipeline
+        allocate_buffers()
 
 def make_readSettingQuery():
-    """Create combined SCPI query to read all settings at once"""
+    """Create combined SCPI query to read all settings at once. The SCPI
+    commands are validated by the instrument, unless the validated map for
+    the same instrument model, firmware and PV definitions is cached."""
+    scpiDefs = {}
     for pvdef in C_.PvDefs:
         pvname = pvdef[0]
         # if setter is defined, add it to the setterMap
@@ -490,6 +1813,26 @@ def make_readSettingQuery():
             continue
         scpi = scpi.replace('<n>',pvname[2])#
         scpi = ''.join([char for char in scpi if not char.islower()])# remove lowercase letters
+        scpiDefs[pvname] = scpi
+        if pvdef[3].get('poll') == 'slow':
+            C_.slowSettings.add(pvname)
+        elif pvdef[3].get('poll') == 'critical':
+            C_.criticalSettings.append(pvname)
+    edev.printv(f'setterMap: {C_.setterMap}')
+
+    cacheFile = scpiCache_file(scpiDefs)
+    if cacheFile is not None and not pargs.revalidate:
+        try:
+            with open(cacheFile, encoding='utf-8') as f:
+                cache = json.load(f)
+            C_.scpi = cache['scpi']
+            C_.readSettingQuery = cache['readSettingQuery']
+            edev.printi(f'Validated SCPI map loaded from {cacheFile}')
+            return
+        except (OSError, ValueError, KeyError):
+            edev.printv(f'No valid SCPI cache {cacheFile}')
+
+    for pvname, scpi in scpiDefs.items():
         # check if scpi is correct:
         s = scpi+'?'
         try:
@@ -504,51 +1847,153 @@ def make_readSettingQuery():
         
     C_.readSettingQuery = '?;'.join(C_.scpi.values()) + '?'
     edev.printv(f'readSettingQuery: {C_.readSettingQuery}')
-    edev.printv(f'setterMap: {C_.setterMap}')
+    if cacheFile is not None:
+        try:
+            os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+            tmp = f'{cacheFile}.{os.getpid()}'# the file may be shared by several servers
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'idn':C_.idn, 'scpi':C_.scpi,
+                    'readSettingQuery':C_.readSettingQuery}, f, indent=1)
+            os.replace(tmp, cacheFile)
+            edev.printi(f'Validated SCPI map saved to {cacheFile}')
+        except OSError as e:
+            edev.printw(f'Could not save SCPI cache: {e}')
+
+def scpiCache_file(scpiDefs):
+    """Return name of the SCPI cache file for the instrument model, firmware
+    and SCPI definitions, or None if caching is disabled."""
+    if not pargs.scpiCache:
+        return None
+    idn = C_.idn.split(',')
+    model = idn[1:2] + idn[3:4]# serial number is not relevant
+    key = json.dumps([idn[:1] + model, scpiDefs], sort_keys=True)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(os.path.expanduser(pargs.scpiCache), f'scpi_{digest}.json')
 
 def init():
     """Module initialization"""
     init_visa()
     make_readSettingQuery()
     adopt_local_setting()
+    start_workers()
+    threading.Thread(target=settings_worker, daemon=True).start()
+    edev.pvobj('tAxis').onFirstConnect(tAxis_connected)
+    edev.pvobj('tAxis').onLastDisconnect(tAxis_disconnected)
 
 def periodicUpdate():
-    """Called for infrequent updates"""
-    while Threadlock.locked():
-        edev.printi('periodicUpdate waiting for lock to be released')
-        time.sleep(0.1)
-    try:
-        update_scopeParameters()
-    except:
-        handle_exception('in update_scopeParameters')
+    """Called for infrequent updates. The settings poll is requested from
+    the settings thread, the acquisition thread does not wait for it."""
+    C_.lastPeriodic = timer()
+    C_.settingsRequest.set()
+    publish_lostTriggers()
+    if C_.acqQueue is not None:
+        edev.publish('queueDepth', C_.acqQueue.qsize(), IF_CHANGED)
+        edev.publish('queueDrops', C_.queueDrops, IF_CHANGED)
+    publish_recording()
+    publish_historyCount()
+    publish_timing()
+
+def settings_worker():
+    """Thread function, polling the scope settings when requested by
+    periodicUpdate(). It takes the instrument lock with normal priority, so
+    a waiting trigger detection or waveform readout goes first. A readout
+    can only wait for the one settings query, which is already in progress."""
+    while True:
+        C_.settingsRequest.wait()
+        C_.settingsRequest.clear()
+        try:
+            ts = timer()
+            update_scopeParameters(poll_settings(settings_due()))
+            C_.settingsPollTime = timer() - ts
+        except:
+            handle_exception('in update_scopeParameters')
+
+def publish_lostTriggers():
+    """Publish acquisition counters, rate of lost triggers and fraction of
+    dead time since previous call."""
+    edev.publish('scopeAcqCount', C_.scopeAcqCount, IF_CHANGED)
     edev.publish('lostTrigs', C_.triggersLost, IF_CHANGED)
-    edev.publish('timing', [(round(-i,6)) for i in ElapsedTime.values()])
+    current = (timer(), C_.triggersLost, C_.deadTime)
+    if C_.lastRates is not None:
+        dt = current[0] - C_.lastRates[0]
+        edev.publish('lostTrigRate', round((current[1] - C_.lastRates[1])/dt, 3))
+        edev.publish('deadTime', round((current[2] - C_.lastRates[2])/dt, 4))
+    C_.lastRates = current
+
+def trigger_rate():
+    """Estimated rate of trigger detections from their latest times.
+    The estimate decays when no triggers are detected."""
+    times = C_.trigTimes
+    if len(times) < 2:
+        return 0.
+    span = times[-1] - times[0]
+    return min((len(times) - 1)/span if span > 0 else float('inf'),
+        len(times)/(timer() - times[0]))
+
+def publish_interval(pvName, value):
+    """Publish an interval if it differs by more than 10% from the posted
+    float32 value, the exact comparison would re-post it on every pass."""
+    if abs(float(edev.pvv(pvName)) - value) > 0.1*value:
+        edev.publish(pvName, value)
+
+def schedule():
+    """In Adaptive pollMode adapt the main-loop intervals to the trigger
+    rate, return True if the periodic update is due, None in other modes,
+    where the periodic update follows edev.sleep(). The sleep PV, set by
+    the operator, is saved when Adaptive mode is entered and restored when
+    it is left.
+    The trigger is polled PollsPerTrigger times per expected trigger period.
+    When triggers are frequent, the settings poll delays their readout, so
+    the settings-refresh interval is stretched to keep the settings poll
+    below SettingsDuty of the time. The trigger-poll interval is applied
+    through the sleep PV."""
+    PollsPerTrigger = 4
+    SettingsDuty = 0.01
+    adaptive = str(edev.pvv('pollMode')) == 'Adaptive'
+    if adaptive != (C_.fixedSleep is not None):# mode changed
+        if adaptive:
+            C_.fixedSleep = float(edev.pvv('sleep'))
+        else:
+            edev.publish('sleep', C_.fixedSleep)
+            C_.fixedSleep = None
+    if not adaptive:
+        return None
+    rate = trigger_rate()
+    lo, hi = float(edev.pvv('pollIntervalMin')), float(edev.pvv('pollIntervalMax'))
+    pollInterval = min(max(1./(PollsPerTrigger*rate) if rate > 0 else hi, lo), hi)
+    lo = float(edev.pvv('settingsIntervalMin'))
+    hi = max(float(edev.pvv('settingsIntervalMax')), lo)
+    settingsInterval = lo
+    if rate*lo > 1.:# more than one trigger per settings refresh
+        settingsInterval = min(max(C_.settingsPollTime/SettingsDuty, lo), hi)
+    publish_interval('sleep', pollInterval)
+    publish_interval('pollInterval', pollInterval)
+    publish_interval('settingsInterval', settingsInterval)
+    if timer() - C_.lastPeriodic < settingsInterval:
+        return False
+    edev.publish('trigRate', round(rate, 3), IF_CHANGED)
+    return True
 
 def poll():
     """Instrument polling function"""
     if trigger_is_detected():
-        with Threadlock:
-            acquire_waveforms()
+        with Threadlock.urgent():
+            acq = acquire_waveforms()
+        submit_acquisition(acq)
 
-#``````````````````Main```````````````````````````````````````````````````````
-if __name__ == "__main__":
-    # Argument parsing
-    parser = argparse.ArgumentParser(description = __doc__,
-    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-    epilog=f'{__version__}')
-    parser.add_argument('-c', '--channels', type=int, default=4, help=
-    'Number of channels per device')
-    parser.add_argument('-d', '--device', default='rohde', help=
-    'Device name, the PV name will be <device><index>:')
-    parser.add_argument('-i', '--index', default='0', help=
-    'Device index, the PV name will be <device><index>:') 
-    parser.add_argument('-r', '--resource', default='TCPIP::192.168.1.100::INSTR', help=
-    'Resource string to access the device, e.g. TCPIP::192.168.1.100::hislip0')
-    parser.add_argument('-v', '--verbose', action='count', default=0, help=
-    'Show more log messages (-vv: show even more)') 
-    pargs = parser.parse_args()
-    print(f'pargs: {pargs}')
+def loop_pass(state):
+    """One pass of the main loop in server state state"""
+    flush_writes()
+    if not state.startswith('Stop'):
+        poll()
+    due = schedule()
+    periodic = not edev.sleep()
+    if periodic if due is None else due:
+        periodicUpdate()
 
+#``````````````````Main```````````````````````````````````````````````````````
+def run_device():
+    """Serve the device of pargs.resource until the server is exited"""
     # Initialize epicsdev and PVs
     pargs.prefix = f'{pargs.device}{pargs.index}:'
     C_.PvDefs = myPVDefs()
@@ -567,8 +2012,104 @@ if __name__ == "__main__":
         state = edev.serverState()
         if state.startswith('Exit'):
             break
-        if not state.startswith('Stop'):
-            poll()
-        if not edev.sleep():
-            periodicUpdate()
+        loop_pass(state)
+    stop_statistics()
     edev.printi('Server is exited')
+
+def device_process(args, resource, index):
+    """Entry point of the spawned process, serving one device"""
+    global pargs
+    pargs = args
+    pargs.resource, pargs.index = resource, index
+    if pargs.prometheus:# one file per device
+        root, ext = os.path.splitext(pargs.prometheus)
+        pargs.prometheus = f'{root}_{pargs.device}{index}{ext}'
+    run_device()
+
+def supervise(resources):
+    """Launch and supervise a server process per device. This is a process
+    launcher, not a multi-device server: epicsdev and the state of this
+    module hold a single device per process, so each device still costs its
+    own interpreter, p4p server and imports, the memory and startup time of
+    N separate servers are not saved.
+    The processes are spawned, not forked, because the EPICS and p4p threads
+    of the parent cannot be used in a forked child. They are not daemonic,
+    so they can start their statistics process pools. A failure or a timeout
+    of one device does not affect the others. Failed processes are restarted."""
+    RestartDelay = 10.# S
+    ctx = multiprocessing.get_context('spawn')
+    # the spawned process imports the target by module name, __main__ of
+    # the program is not importable
+    import epicsdev_rohde.__main__ as server# pylint: disable=import-outside-toplevel
+    try:
+        first = int(pargs.index)
+        indexes = [str(first+i) for i in range(len(resources))]
+    except ValueError:
+        indexes = [f'{pargs.index}{i}' for i in range(len(resources))]
+    devices = {}# {index:[resource, process, restart time]}
+    for resource, index in zip(resources, indexes):
+        devices[index] = [resource, None, 0.]
+    try:
+        while devices:
+            for index, device in list(devices.items()):
+                resource, process, restartTime = device
+                if process is not None:
+                    if process.is_alive():
+                        continue
+                    if process.exitcode == 0:
+                        print(f'Server for {resource} exited')
+                        del devices[index]
+                        continue
+                    print(f'Server for {resource} failed (exit code {process.exitcode}), '
+                        f'restarting in {RestartDelay} S')
+                    device[1:] = [None, time.time() + RestartDelay]
+                    continue
+                if time.time() < restartTime:
+                    continue
+                device[1] = ctx.Process(target=server.device_process,
+                    args=(pargs, resource, index), name=f'{pargs.device}{index}')
+                device[1].start()
+                print(f'Started server {pargs.device}{index} for {resource}, pid {device[1].pid}')
+            time.sleep(1.)
+    except KeyboardInterrupt:
+        for _, process, _ in devices.values():
+            if process is not None:
+                process.terminate()
+                process.join()
+
+if __name__ == "__main__":
+    # Argument parsing
+    parser = argparse.ArgumentParser(description = __doc__,
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    epilog=f'{__version__}')
+    parser.add_argument('-c', '--channels', type=int, default=4, help=
+    'Number of channels per device')
+    parser.add_argument('-d', '--device', default='rohde', help=
+    'Device name, the PV name will be <device><index>:')
+    parser.add_argument('-i', '--index', default='0', help=
+    'Device index, the PV name will be <device><index>:') 
+    parser.add_argument('-j', '--statProcesses', type=int, default=0, help=
+    'Number of processes for waveform statistics, 0: calculate in the processing threads')
+    parser.add_argument('-p', '--prometheus', help=
+    'File to write timing statistics in Prometheus text format')
+    parser.add_argument('-q', '--queueSize', type=int, default=4, help=
+    'Max number of acquisitions waiting for processing')
+    parser.add_argument('-r', '--resource', default='TCPIP::192.168.1.100::INSTR', help=
+    'Resource string to access the device, e.g. TCPIP::192.168.1.100::hislip0. '
+    'Comma-separated list for several devices, the device index is incremented for each')
+    parser.add_argument('--revalidate', action='store_true', help=
+    'Validate SCPI commands of the PVs by the instrument, even if they are cached')
+    parser.add_argument('-s', '--scpiCache', default='~/.cache/epicsdev_rohde', help=
+    'Directory to cache the validated SCPI map, empty string: no caching')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help=
+    'Show more log messages (-vv: show even more)') 
+    parser.add_argument('-w', '--workers', type=int, default=1, help=
+    'Number of processing threads, 0: process waveforms in the acquisition thread')
+    pargs = parser.parse_args()
+    print(f'pargs: {pargs}')
+
+    resources = pargs.resource.split(',')
+    if len(resources) == 1:
+        run_device()
+    else:
+        supervise(resources)
@@ -0,0 +1,216 @@
+"""Acquisition throughput benchmark. It runs the server against the
+simulated oscilloscope (or a real one) for a sweep of record lengths and
+channel counts and prints results as JSON. Log messages are redirected to
+stderr.
+Modes:
+    direct  acquire-convert-publish path, called one acquisition at a time
+    loop    main loop of the server: poll(), the processing queue and
+            workers (-w, -q), ordered publishing and the setter writes
+
+Usage:
+    python -m epicsdev_rohde.bench -n 10k,1M,10M -c 1,4 -a 20
+    python -m epicsdev_rohde.bench -n 1M -c 4 -f INT,8/INT,16/REAL,32
+    python -m epicsdev_rohde.bench -m loop -w 2 -q 4 -n 1M -c 4 -a 100
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.1.0 26-10-18'
+
+import sys
+import json
+import time
+import resource
+import argparse
+from argparse import Namespace
+from time import perf_counter as timer
+import numpy as np
+
+from epicsdev import epicsdev as edev
+from epicsdev_rohde import simscope
+import epicsdev_rohde.__main__ as srv
+
+Stages = srv.Stages
+
+def parse_count(txt):
+    """Parse number with optional k/M suffix"""
+    mult = {'k':1000, 'M':1000000}.get(txt[-1], 1)
+    return int(float(txt.rstrip('kM'))*mult)
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the process, Linux only.
+    Returns True if the peak is reset."""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def rss():
+    """Current and peak resident set size of the process, MB. The peak is
+    since the last reset_peak_rss() on Linux, otherwise since the start."""
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            status = dict(line.split(':', 1) for line in f)
+        return [int(status[key].split()[0])/1024. for key in ('VmRSS','VmHWM')]
+    except (OSError, KeyError):
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return None, r/1024. if sys.platform != 'darwin' else r/1024./1024.
+
+def start_server(pargs):
+    """Start simulator, if needed, and initialize the server module"""
+    if not pargs.resource:
+        simscope.start(Namespace(port=pargs.port, channels=pargs.channels,
+            npoints=1000, rate=pargs.rate, latency=pargs.latency,
+            bandwidth=pargs.bandwidth, dropEvery=0, verbose=0))
+        pargs.resource = f'TCPIP::127.0.0.1::{pargs.port}::SOCKET'
+    loop = pargs.mode == 'loop'
+    srv.pargs = Namespace(resource=pargs.resource, channels=pargs.channels,
+        workers=pargs.workers if loop else 0, queueSize=pargs.queueSize,
+        prometheus=None, scpiCache='', revalidate=False,
+        statProcesses=pargs.statProcesses, verbose=0)
+    srv.C_.PvDefs = srv.myPVDefs()
+    edev.init_epicsdev('bench0:', srv.C_.PvDefs, 0, srv.serverStateChanged,
+        listDir='')
+    srv.init()
+    edev.set_server('Start')
+    edev.publish('sleep', pargs.sleep)
+    if srv.C_.statPool is not None:# wait for the spawned processes
+        for future in [srv.C_.statPool.submit(time.sleep, 0.1)
+                for _ in range(pargs.statProcesses)]:
+            future.result()
+
+def configure(npoints, nchannels, dataFormat):
+    """Set data format, record length and enable first nchannels channels"""
+    srv.set_dataFormat(dataFormat)
+    cmds = [f'ACQuire:POINts {npoints}']
+    for ch in range(1, srv.pargs.channels+1):
+        cmds.append(f'CHANnel{ch}:STATe {"ON" if ch <= nchannels else "OFF"}')
+    srv.scopeCmd(';:'.join(cmds))
+    srv.update_scopeParameters()
+
+def run_direct(nacq, samples):
+    """Acquire and publish nacq acquisitions one at a time, return the
+    number of published acquisitions"""
+    for _ in range(nacq):
+        ts = timer()
+        while not srv.trigger_is_detected():
+            pass
+        samples['trigger_detection'].append(timer() - ts)
+        with srv.Threadlock.urgent():
+            acq = srv.acquire_waveforms()
+        srv.publish_waveforms(acq)
+        for stage in Stages[1:]:# last times of the stages
+            samples[stage].append(srv.ElapsedTime.get(stage, 0.))
+    return nacq
+
+def run_loop(nacq, samples):
+    """Run the main loop of the server until nacq triggers are detected
+    and the processing queue is drained, return the number of published
+    acquisitions. The stage times are sampled after each acquisition, the
+    processing stage is the latest one finished by a worker."""
+    n0, drops0 = srv.C_.numacq, srv.C_.queueDrops
+    while srv.C_.numacq - n0 < nacq:
+        numacq = srv.C_.numacq
+        srv.loop_pass(edev.serverState())
+        if srv.C_.numacq != numacq:
+            for stage in Stages:
+                samples[stage].append(srv.ElapsedTime.get(stage, 0.))
+    if srv.C_.acqQueue is not None:
+        srv.C_.acqQueue.join()
+    return nacq - (srv.C_.queueDrops - drops0)
+
+def run_point(npoints, nchannels, dataFormat, nacq, mode):
+    """Measure nacq acquisitions, return dict of results"""
+    configure(npoints, nchannels, dataFormat)
+    samples = {stage:[] for stage in Stages}
+    rss0 = rss()[0]
+    perPoint = reset_peak_rss()
+    drops0, lost0 = srv.C_.queueDrops, srv.C_.triggersLost
+    t0 = timer()
+    published = (run_loop if mode == 'loop' else run_direct)(nacq, samples)
+    elapsed = timer() - t0
+    wireBytes = srv.C_.npoints*srv.C_.wireDtype.itemsize*nchannels
+    current, peak = rss()
+    r = {'recLength':npoints, 'channels':nchannels, 'dataFormat':dataFormat,
+        'mode':mode, 'acquisitions':nacq, 'published':published,
+        'queueDrops':srv.C_.queueDrops - drops0,
+        'lostTrigs':srv.C_.triggersLost - lost0,
+        'acqPerSec':round(published/elapsed, 3),
+        'MBPerSec':round(published*wireBytes/elapsed/1e6, 3),
+        'startRSS_MB':None if rss0 is None else round(rss0, 1),
+        'endRSS_MB':None if current is None else round(current, 1),
+        'peakRSS_MB':round(peak, 1),
+        'peakRSS':'point' if perPoint else 'process', 'stages':{}}
+    for stage, values in samples.items():
+        if not values:
+            continue
+        p50, p99 = np.percentile(values, [50, 99])
+        r['stages'][stage] = {'p50':round(p50, 6), 'p99':round(p99, 6)}
+    return r
+
+def main():
+    """Run the benchmark"""
+    parser = argparse.ArgumentParser(description = __doc__,
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    epilog=f'{__version__}')
+    parser.add_argument('-a', '--acquisitions', type=int, default=20, help=
+    'Number of acquisitions per measurement')
+    parser.add_argument('-b', '--bandwidth', type=float, default=0., help=
+    'Link bandwidth of the simulator, MB/s, 0: unlimited')
+    parser.add_argument('-c', '--nchannels', default='1,4', help=
+    'Comma-separated list of numbers of enabled channels')
+    parser.add_argument('-f', '--dataFormats', default='INT,16', help=
+    'Slash-separated list of data formats: INT,8, INT,16, REAL,32')
+    parser.add_argument('-j', '--statProcesses', type=int, default=0, help=
+    'Number of processes for waveform statistics')
+    parser.add_argument('-l', '--latency', type=float, default=0., help=
+    'Reply latency of the simulator, S')
+    parser.add_argument('-m', '--mode', choices=('direct','loop'), default='direct', help=
+    'direct: acquire-convert-publish calls, loop: main loop of the server')
+    parser.add_argument('-n', '--recLengths', default='10k,100k,1M', help=
+    'Comma-separated list of record lengths')
+    parser.add_argument('-o', '--output', help=
+    'File to write JSON results, default: stdout')
+    parser.add_argument('-p', '--port', type=int, default=5125, help=
+    'TCP port of the simulator')
+    parser.add_argument('-q', '--queueSize', type=int, default=4, help=
+    'Max number of acquisitions waiting for processing, loop mode')
+    parser.add_argument('-r', '--resource', default='', help=
+    'Resource of a real scope, if not given, the simulator is used')
+    parser.add_argument('-s', '--sleep', type=float, default=0., help=
+    'Sleep of the main loop, S, loop mode')
+    parser.add_argument('-t', '--rate', type=float, default=1000., help=
+    'Trigger rate of the simulator, Hz')
+    parser.add_argument('-w', '--workers', type=int, default=0, help=
+    'Number of processing workers, loop mode')
+    pargs = parser.parse_args()
+    pargs.channels = 4
+
+    out, sys.stdout = sys.stdout, sys.stderr# keep stdout for results only
+    results = run(pargs)
+    txt = json.dumps(results, indent=1)
+    if pargs.output:
+        with open(pargs.output, 'w', encoding='utf-8') as f:
+            f.write(txt)
+    else:
+        print(txt, file=out)
+
+def run(pargs):
+    """Run the sweep, return results"""
+    start_server(pargs)
+    results = {'resource':pargs.resource, 'time':time.strftime('%Y-%m-%d %H:%M:%S'),
+        'version':srv.__version__, 'points':[]}
+    for npoints in [parse_count(i) for i in pargs.recLengths.split(',')]:
+        for nchannels in [int(i) for i in pargs.nchannels.split(',')]:
+            for dataFormat in pargs.dataFormats.split('/'):
+                r = run_point(npoints, nchannels, dataFormat, pargs.acquisitions,
+                    pargs.mode)
+                print(f'{npoints} points, {nchannels} channels, {dataFormat}:'
+                    f' {r["acqPerSec"]} acq/s')
+                results['points'].append(r)
+    srv.stop_statistics()
+    edev.set_server('Exit')
+    return results
+
+if __name__ == "__main__":
+    main()
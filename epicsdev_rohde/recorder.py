@@ -0,0 +1,99 @@
+"""Recording of raw waveforms to memory-mapped ring files.
+
+A recording consists of two numpy files, which can be opened with
+numpy.load(fileName, mmap_mode='r'):
+    <name>.npy        int16 ring of raw samples, preallocated,
+    <name>_index.npy  ring of index entries, one per channel waveform,
+                      see IndexDtype.
+The waveform of an entry is data[pos % len(data):][:npoints], volts are
+raw*gain + offset. The waveforms never wrap around the end of the data ring.
+When the ring is full, the oldest waveforms are overwritten.
+
+Usage:
+    from epicsdev_rohde import recorder
+    for entry, raw in recorder.read_records('/tmp/rohde_rohde0_20261018_120000'):
+        volts = raw*entry['gain'] + entry['offset']
+"""
+# pylint: disable=invalid-name
+import os
+import time
+import numpy as np
+
+IndexDtype = np.dtype([
+    ('count', '<i8'),   # acquisition count, -1: entry not written
+    ('time', '<f8'),    # trigger time, seconds since Epoch
+    ('channel', '<u2'),
+    ('npoints', '<u4'),
+    ('pos', '<u8'),     # position of the first sample in the data stream
+    ('gain', '<f8'),
+    ('offset', '<f8'),
+])
+MinRecordLength = 1000# the index is sized for waveforms of this length
+
+class RingFile():
+    """Ring file of raw waveforms, preallocated to nbytes"""
+    def __init__(self, name:str, nbytes:int):
+        self.name = name
+        self.startTime = time.time()
+        nsamples = max(nbytes//2, MinRecordLength)
+        self.data = np.lib.format.open_memmap(name+'.npy', 'w+', '<i2', (nsamples,))
+        preallocate(name+'.npy')
+        self.index = np.lib.format.open_memmap(name+'_index.npy', 'w+',
+            IndexDtype, (nsamples//MinRecordLength + 1,))
+        self.index['count'] = -1
+        self.pos = 0# samples written to the data stream
+        self.nentries = 0
+
+    def write(self, count:int, t:float, channel:int, waveform, gain:float,
+            offset:float):
+        """Append waveform, return number of bytes written"""
+        n = len(waveform)
+        size = len(self.data)
+        if n > size:
+            raise ValueError(f'Waveform of {n} points does not fit in {self.name}')
+        start = self.pos % size
+        if start + n > size:# skip to the beginning of the ring
+            self.pos += size - start
+            start = 0
+        self.data[start:start+n] = waveform
+        self.index[self.nentries % len(self.index)] = (count, t, channel, n,
+            self.pos, gain, offset)
+        self.pos += n
+        self.nentries += 1
+        return n*2
+
+    def close(self):
+        """Flush and close the files"""
+        self.data.flush()
+        self.index.flush()
+        del self.data, self.index
+
+def preallocate(fileName):
+    """Allocate disk space of the file, so writing does not fail later
+    when the disk is full"""
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    with open(fileName, 'r+b') as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, os.path.getsize(fileName))
+        except OSError:# not supported by the file system
+            pass
+
+def read_records(name:str):
+    """Return list of (index entry, raw waveform) of the recording, which
+    were not overwritten, in order of writing"""
+    data = np.load(name+'.npy', mmap_mode='r')
+    index = np.load(name+'_index.npy', mmap_mode='r')
+    entries = np.sort(index[index['count'] >= 0], order='pos')
+    if len(entries) == 0:
+        return []
+    end = int(entries[-1]['pos']) + int(entries[-1]['npoints'])
+    size = len(data)
+    r = []
+    for entry in entries:
+        pos = int(entry['pos'])
+        if pos < end - size:# overwritten
+            continue
+        start = pos % size
+        r.append((entry, data[start:start+int(entry['npoints'])]))
+    return r
@@ -0,0 +1,437 @@
+"""Simulated Rohde&Schwarz oscilloscope, serving SCPI over a raw TCP socket.
+It supports the commands used by epicsdev_rohde and generates synthetic
+waveforms in INT,8, INT,16 or REAL,32 format, so that the server can be tested without an instrument.
+
+Usage:
+    python -m epicsdev_rohde.simscope -p 5025 -t 10
+    python -m epicsdev_rohde -r 'TCPIP::127.0.0.1::5025::SOCKET'
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.0 26-10-18'
+
+import re
+import time
+import threading
+import argparse
+import socketserver
+import numpy as np
+
+#``````````````````Constants``````````````````````````````````````````````````
+IDN = 'Rohde&Schwarz,MXO4-SIM,000000,1.0.0'
+NDIVSX = 10
+NMEAS = 8# number of measurement slots
+CodesPerDiv = 6400.# INT,16 codes per vertical division, INT,8 codes are 1/256 of them
+# SCPI mnemonics in long form, the short form is the uppercase part
+Mnemonics = ('ACQuire CURRent POINts SRATe TIMebase SCALe RANGe HORizontal POSition'
+    ' TRIGger TYPE EDGE COUPling STATe MODE SOURce SLOPe LEVel FORCe CHANnel'
+    ' OFFSet DATA VALues FORMat BORDer MMEMory STORe LOAD RUN STOP SINGle'
+    ' RUNSingle SYSTem ERRor NEXT SEGMented COUNt HISTory STARt'
+    ' TSRelative EXPort WAVeform DLOGging MEASurement ENABle MAIN RESult'
+    ' ACTual SCOPe').split()
+NodeMap = {}# {LONG or SHORT: SHORT}
+for _m in Mnemonics:
+    _short = ''.join([c for c in _m if c.isupper()])
+    NodeMap[_m.upper()] = _short
+    NodeMap[_short] = _short
+Multipliers = {'K':1e3, 'M':1e6, 'G':1e9}
+
+class SCPIError(Exception):
+    """SCPI command error"""
+
+#``````````````````Module storage`````````````````````````````````````````````
+class C_():
+    """Namespace for module properties"""
+    pargs = None
+    lock = threading.Lock()
+    settings = {}
+    savedSettings = {}
+    errors = []
+    running = False
+    armTime = 0.
+    stopTime = 0.
+    single = False
+    forced = False
+    esr = 0
+    startTime = time.time()
+    rng = np.random.default_rng()
+    tables = {}# {channel: pregenerated waveform}
+    queryCount = 0
+
+def default_settings(nchannels):
+    """Return default settings of the instrument"""
+    s = {
+    'ACQ:POIN': '10000',
+    'TIM:SCAL': '1e-06',
+    'TIM:HOR:POS': '0.0',
+    'TRIG:TYPE': 'EDGE',
+    'TRIG:EDGE:COUP': 'DC',
+    'TRIG:MODE': 'NORM',
+    'TRIG:SOUR': 'CHAN1',
+    'TRIG:EDGE:SLOP': 'POS',
+    'TRIG:LEV': '0.0',
+    'FORM:DATA': 'INT,16',
+    'FORM:BORD': 'NORM',
+    'ACQ:SEGM:STAT': '0',
+    'ACQ:COUN': '1',
+    'EXP:WAV:DLOG': '0',
+    'EXP:WAV:SCOP': 'WFM',
+    'EXP:WAV:STAR': '0.0',
+    'EXP:WAV:STOP': '0.0',
+    }
+    for ch in range(1, nchannels+1):
+        s[f'CHAN{ch}:STAT'] = '1' if ch == 1 else '0'
+        s[f'CHAN{ch}:COUP'] = 'DC'
+        s[f'CHAN{ch}:SCAL'] = '0.1'
+        s[f'CHAN{ch}:OFFS'] = '0.0'
+        s[f'CHAN{ch}:HIST:STAR'] = '0'
+        s[f'CHAN{ch}:HIST:STOP'] = '0'
+        s[f'CHAN{ch}:HIST:CURR'] = '0'
+    for m in range(1, NMEAS+1):
+        s[f'MEAS{m}:ENAB'] = '0'
+        s[f'MEAS{m}:SOUR'] = 'C1'
+        s[f'MEAS{m}:MAIN'] = 'MEAN'
+    return s
+
+def normalize(header):
+    """Convert header to short form, e.g. ':CHANnel1:SCALe' -> 'CHAN1:SCAL'"""
+    nodes = []
+    for node in header.strip(':').split(':'):
+        m = re.fullmatch(r'([A-Za-z]+)(\d*)', node)
+        if m is None or m.group(1).upper() not in NodeMap:
+            raise SCPIError(f'-113,"Undefined header;{header}"')
+        nodes.append(NodeMap[m.group(1).upper()] + m.group(2))
+    r = ':'.join(nodes)
+    if r.endswith(':DATA:VAL'):
+        r = r[:-4]
+    return r
+
+#``````````````````Acquisition model``````````````````````````````````````````
+def npoints():
+    """Record length"""
+    return int(C_.settings['ACQ:POIN'])
+
+def time_range():
+    """Horizontal time range"""
+    return float(C_.settings['TIM:SCAL'])*NDIVSX
+
+def segments():
+    """Number of acquisitions per single run"""
+    if C_.settings['ACQ:SEGM:STAT'] == '1':
+        return int(C_.settings['ACQ:COUN'])
+    return 1
+
+def acquisition_complete():
+    """True if a trigger (or all triggers of segmented acquisition) occurred
+    after the scope was armed. Triggers occur periodically with the rate given
+    in command line."""
+    if C_.forced:
+        return True
+    if C_.armTime == 0.:
+        return False
+    period = 1./C_.pargs.rate
+    tnow = time.time()
+    nextTrigger = C_.startTime\
+        + (int((C_.armTime - C_.startTime)/period) + segments()) * period
+    return tnow >= nextTrigger + time_range()/2.
+
+def acquisitions():
+    """Reply to ACQuire:CURRent?: number of acquisitions since the scope
+    was armed"""
+    if C_.armTime == 0.:
+        return 0
+    period = 1./C_.pargs.rate
+    end = (time.time() if C_.running else C_.stopTime) - time_range()/2.
+    first = int((C_.armTime - C_.startTime)/period) + 1
+    last = int((end - C_.startTime)/period)
+    n = max(last - first + 1, 0)
+    if C_.forced:
+        n = max(n, 1)
+    return min(n, segments()) if C_.single else n
+
+def trigger_state():
+    """Reply to TRIGger:STATe?"""
+    if not C_.running:
+        return 'STOP'
+    if acquisition_complete():
+        if C_.single:
+            C_.running = False
+            C_.stopTime = time.time()
+            C_.esr |= 1# operation complete
+        return 'COMP'
+    return 'WAIT'
+
+def arm(single):
+    """Start acquisition"""
+    C_.running = True
+    C_.single = single
+    C_.forced = False
+    C_.armTime = time.time()
+
+def waveform(ch):
+    """Return raw waveform of the channel. The waveforms are slices, taken
+    with random offset from pregenerated tables, to keep the generation
+    time low at long record lengths. If data logging of the history is on,
+    all segments are returned."""
+    if C_.settings['EXP:WAV:DLOG'] == '1':
+        nseg = int(C_.settings[f'CHAN{ch}:HIST:STOP'])\
+            - int(C_.settings[f'CHAN{ch}:HIST:STAR']) + 1
+        return np.concatenate([segment(ch) for _ in range(max(nseg, 1))])
+    return segment(ch)
+
+def export_window(n):
+    """Range of points of the record of n points, transferred by
+    CHANnel<n>:DATA?, as set by EXPort:WAVeform:SCOPe MANual"""
+    if not C_.settings['EXP:WAV:SCOP'].upper().startswith('MAN'):
+        return 0, n
+    dx = time_range()/n
+    x0 = -time_range()/2.
+    i0, i1 = [min(max(round((float(C_.settings[key]) - x0)/dx), 0), n)
+        for key in ('EXP:WAV:STAR', 'EXP:WAV:STOP')]
+    return i0, max(i0, i1)
+
+def segment(ch, window=True):
+    """Return one acquisition of the channel, limited to the export window"""
+    n = npoints()
+    extra = 1000
+    table = C_.tables.get(ch)
+    if table is None or len(table) != n + extra:
+        x = np.arange(n + extra)
+        amp = 4000.*ch
+        table = amp*np.sin(2.*np.pi*x*ch/max(n, 1)*4.)\
+            + C_.rng.normal(0., 200., n + extra)
+        table = C_.tables[ch] = table.astype('<i2')
+    off = C_.rng.integers(extra)
+    i0, i1 = export_window(n) if window else (0, n)
+    return table[off+i0:off+i1]
+
+def volts(ch, raw):
+    """Convert INT,16 codes of the channel to volts"""
+    return raw*(float(C_.settings[f'CHAN{ch}:SCAL'])/CodesPerDiv)\
+        + float(C_.settings[f'CHAN{ch}:OFFS'])
+
+def data_bytes(ch, raw):
+    """Encode INT,16 codes of the channel in the current FORMat:DATA and
+    FORMat:BORDer"""
+    fmt = C_.settings['FORM:DATA'].upper()
+    order = '>' if C_.settings['FORM:BORD'].upper().startswith(('MSB','SWAP')) else '<'
+    if fmt == 'INT,8':
+        return (raw >> 8).astype('i1').tobytes()
+    if fmt == 'REAL,32':
+        return volts(ch, raw).astype(order+'f4').tobytes()
+    return raw.astype(order+'i2').tobytes()
+
+def measurement(slot):
+    """Result of the measurement slot on the current waveform: MEAN or
+    PDELta (peak-to-peak), in volts"""
+    if C_.settings.get(f'MEAS{slot}:ENAB') != '1':
+        raise SCPIError(f'-221,"Settings conflict;measurement {slot} is not enabled"')
+    ch = int(C_.settings[f'MEAS{slot}:SOUR'].upper().lstrip('CHAN'))
+    raw = segment(ch, window=False)
+    if C_.settings[f'MEAS{slot}:MAIN'].upper().startswith('PDEL'):
+        return (int(raw.max()) - int(raw.min()))*float(C_.settings[f'CHAN{ch}:SCAL'])/CodesPerDiv
+    return volts(ch, float(raw.mean()))
+
+def binary_block(data:bytes):
+    """IEEE-488.2 definite-length block"""
+    length = str(len(data)).encode()
+    return b'#' + str(len(length)).encode() + length + data
+
+def parse_points(value):
+    """Parse record length: 10000, 10k, 10M, AUTO"""
+    value = value.upper()
+    if value == 'AUTO':
+        return int(C_.settings['ACQ:POIN'])
+    mult = Multipliers.get(value[-1], 1)
+    if value[-1] in Multipliers:
+        value = value[:-1]
+    return int(float(value)*mult)
+
+#``````````````````Command execution``````````````````````````````````````````
+def execute(cmd):
+    """Execute one SCPI command, return reply (str or bytes) or None"""
+    cmd = cmd.strip()
+    if not cmd:
+        return None
+    header, _, arg = cmd.partition(' ')
+    isQuery = header.endswith('?')
+    header = header.rstrip('?')
+    arg = arg.strip()
+
+    # common commands
+    if header.startswith('*'):
+        h = header.upper()
+        if h == '*IDN':
+            return IDN
+        if h == '*CLS':
+            C_.errors.clear()
+            C_.esr = 0
+        elif h == '*RST':
+            C_.settings = default_settings(C_.pargs.channels)
+        elif h == '*ESR':
+            trigger_state()# sets operation complete of a finished single run
+            r, C_.esr = C_.esr, 0
+            return str(r)
+        elif h == '*STB':
+            trigger_state()
+            return str(32 if C_.esr else 0)
+        elif h == '*OPC' and isQuery:# wait for pending acquisition
+            while C_.running and C_.single and trigger_state() != 'COMP':
+                time.sleep(0.001)
+            return '1'
+        elif h in ('*OPC','*ESE','*SRE'):
+            pass
+        else:
+            raise SCPIError(f'-113,"Undefined header;{header}"')
+        return None
+
+    key = normalize(header)
+    if key in ('RUN', 'STOP', 'SING', 'RUNS'):
+        if key != 'STOP':
+            arm(single = key != 'RUN')
+        elif C_.running:
+            C_.running = False
+            C_.stopTime = time.time()
+        return None
+    if key == 'TRIG:FORC':
+        C_.forced = True
+        return None
+    if key == 'TRIG:STAT':
+        return trigger_state()
+    if key == 'SYST:ERR' or key == 'SYST:ERR:NEXT':
+        return C_.errors.pop(0) if C_.errors else '0,"No error"'
+    if key == 'TIM:RANG':
+        if isQuery:
+            return repr(time_range())
+        C_.settings['TIM:SCAL'] = repr(float(arg)/NDIVSX)
+        return None
+    m = re.fullmatch(r'CHAN(\d+):HIST:TSR', key)
+    if m:
+        current = int(C_.settings[f'CHAN{m.group(1)}:HIST:CURR'])
+        return repr(current/C_.pargs.rate)
+    m = re.fullmatch(r'MEAS(\d+):RES:ACT', key)
+    if m:
+        return repr(measurement(int(m.group(1))))
+    if key == 'ACQ:CURR':
+        return str(acquisitions())
+    if key == 'ACQ:SRAT':
+        return repr(npoints()/time_range())
+    if key in ('MMEM:STOR:STAT', 'MMEM:LOAD:STAT'):
+        slot = arg.split(',')[-1].strip('"')
+        if key == 'MMEM:STOR:STAT':
+            C_.savedSettings[slot] = dict(C_.settings)
+        elif slot in C_.savedSettings:
+            C_.settings = dict(C_.savedSettings[slot])
+        return None
+    m = re.fullmatch(r'CHAN(\d+):DATA', key)
+    if m:
+        ch = int(m.group(1))
+        return binary_block(data_bytes(ch, waveform(ch)))
+    if key not in C_.settings:
+        raise SCPIError(f'-113,"Undefined header;{header}"')
+    if isQuery:
+        return C_.settings[key]
+    if key == 'ACQ:POIN':
+        arg = str(parse_points(arg))
+    elif key.endswith(('SCAL','OFFS','LEV','POS')):
+        arg = repr(float(arg))
+    elif key == 'FORM:DATA':
+        arg = arg.upper().replace(' ', '')
+        if arg not in ('INT,8', 'INT,16', 'REAL,32'):
+            raise SCPIError(f'-224,"Illegal parameter value;{cmd}"')
+    elif key.endswith(('STAT','DLOG','ENAB')):
+        arg = '1' if arg.upper() in ('1','ON') else '0'
+    C_.settings[key] = arg
+    return None
+
+def execute_message(msg):
+    """Execute ';'-separated program message. Returns reply in bytes or
+    None if there is nothing to reply."""
+    replies = []
+    for cmd in msg.split(';'):
+        try:
+            r = execute(cmd)
+        except (SCPIError, ValueError) as e:
+            err = str(e) if isinstance(e, SCPIError)\
+                else f'-224,"Illegal parameter value;{cmd}"'
+            C_.errors.append(err)
+            if C_.pargs.verbose:
+                print(f'SCPI error: {err}')
+            return None# no reply, the client will time out, as with real scope
+        if r is not None:
+            replies.append(r if isinstance(r, bytes) else r.encode())
+    if not replies:
+        return None
+    return b';'.join(replies) + b'\n'
+
+class SCPIHandler(socketserver.StreamRequestHandler):
+    """Handles one client connection"""
+    def handle(self):
+        print(f'Client connected: {self.client_address}')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            msg = line.decode(errors='replace').strip()
+            if C_.pargs.verbose > 1:
+                print(f'> {msg}')
+            with C_.lock:
+                reply = execute_message(msg)
+            if reply is None:
+                continue
+            C_.queryCount += 1
+            if C_.pargs.dropEvery and C_.queryCount % C_.pargs.dropEvery == 0:
+                print(f'Reply to {msg[:40]} dropped')
+                continue
+            time.sleep(C_.pargs.latency)
+            if C_.pargs.bandwidth:
+                time.sleep(len(reply)/(C_.pargs.bandwidth*1e6))
+            self.wfile.write(reply)
+        print(f'Client disconnected: {self.client_address}')
+
+class Server(socketserver.ThreadingTCPServer):
+    """TCP server for simulated instrument"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+def start(pargs):
+    """Initialize the instrument and start the server in a thread.
+    Returns the server."""
+    C_.pargs = pargs
+    C_.settings = default_settings(pargs.channels)
+    C_.settings['ACQ:POIN'] = str(pargs.npoints)
+    server = Server(('', pargs.port), SCPIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def parser():
+    """Command line parser"""
+    p = argparse.ArgumentParser(description = __doc__,
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    epilog=f'{__version__}')
+    p.add_argument('-b', '--bandwidth', type=float, default=0., help=
+    'Emulated link bandwidth, MB/s, 0: unlimited')
+    p.add_argument('-c', '--channels', type=int, default=4, help=
+    'Number of channels')
+    p.add_argument('-d', '--dropEvery', type=int, default=0, help=
+    'Drop reply to every Nth query to emulate timeouts, 0: never')
+    p.add_argument('-l', '--latency', type=float, default=0., help=
+    'Delay of every reply, S')
+    p.add_argument('-n', '--npoints', type=int, default=10000, help=
+    'Initial record length')
+    p.add_argument('-p', '--port', type=int, default=5025, help=
+    'TCP port')
+    p.add_argument('-t', '--rate', type=float, default=10., help=
+    'Trigger rate, Hz')
+    p.add_argument('-v', '--verbose', action='count', default=0, help=
+    'Show more log messages (-vv: show every command)')
+    return p
+
+if __name__ == "__main__":
+    pargs = parser().parse_args()
+    server = start(pargs)
+    print(f'Simulated scope {IDN} is listening on port {pargs.port}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,69 @@
+"""Statistics of raw waveforms, calculated by the server threads or by the
+statistics process pool.
+
+The module imports only numpy, so the spawned processes of the pool start
+quickly. The pool processes read the waveforms from the shared memory
+block of the server buffers, the tasks pass the block name and the
+position of the waveform in it.
+"""
+# pylint: disable=invalid-name
+from multiprocessing import shared_memory
+import numpy as np
+
+_attached = {}# {block name:SharedMemory}, attached by the pool process
+
+def waveform_statistics(x, full, gate, chunk=1000000):
+    """Statistics of the raw waveform x in raw counts and points: min, max,
+    sum and, if full, sum of squares, rise time and sum within the gate
+    (first, last) points. Python scalars prevent integer overflow."""
+    sumType = np.int64 if x.dtype.kind == 'i' else np.float64
+    r = {'n':len(x), 'min':x.min().item(), 'max':x.max().item(),
+        'sum':x.sum(dtype=sumType).item()}
+    if not full:
+        return r
+    ss = 0.
+    for i in range(0, len(x), chunk):
+        c = x[i:i+chunk].astype(np.float32)
+        ss += float(np.dot(c, c))
+    r['sumsq'] = ss
+    r['rise'] = rise_points(x, r['min'], r['max'])
+    g = x[gate[0]:gate[1]]
+    r['gateN'], r['gateSum'] = len(g), g.sum(dtype=sumType).item()
+    return r
+
+def rise_points(x, xmin, xmax):
+    """Number of points of the first complete rising edge of x: from the
+    last 10% crossing to the first 90% crossing after x was below 10% of
+    the amplitude. NaN if x has no complete edge, e.g. if the record starts
+    partway up the edge and does not rise again."""
+    lo = xmin + 0.1*(xmax - xmin)
+    hi = xmin + 0.9*(xmax - xmin)
+    if hi <= lo:
+        return float('nan')
+    low = x <= lo
+    i10 = int(np.argmax(low))
+    if not low[i10]:
+        return float('nan')
+    high = x[i10:] >= hi
+    i90 = i10 + int(np.argmax(high))
+    if not high[i90 - i10]:
+        return float('nan')
+    return int(np.argmax(low[i90::-1]))
+
+def pool_statistics(name, dtype, offset, n, full, gate):
+    """Statistics task of the process pool. The waveform of n points is
+    located at offset in the shared memory block name. The block of the
+    previous task is released when a new one is attached. None is returned
+    if the block was unlinked, after the server replaced its buffers."""
+    shm = _attached.get(name)
+    if shm is None:
+        try:
+            shm = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            return None
+        for block in _attached.values():
+            block.close()
+        _attached.clear()
+        _attached[name] = shm
+    x = np.frombuffer(shm.buf, dtype=dtype, count=n, offset=offset)
+    return waveform_statistics(x, full, gate)